@@ -1,6 +1,7 @@
 # This module is adapted from Python 3.2's functools' lru_cache.
 from modified_collections import OrderedDict
 from functools import wraps
+from threading import Lock
 
 
 def lru_cache(maxsize=100):
@@ -26,9 +27,8 @@ def lru_cache(maxsize=100):
                             KeyError=KeyError):
 
         kwd_mark = (object(),)          # separates positional and keyword args
-        # lock = Lock()                 # needed because OrderedDict isn't
+        lock = Lock()                   # needed because OrderedDict isn't
                                         # threadsafe
-        # MaK: ...but not available, unfortunately
 
         if maxsize is None:
             cache = dict()              # simple cache without ordering or size
@@ -58,26 +58,27 @@ def lru_cache(maxsize=100):
                 key = args
                 if kwds:
                     key += kwd_mark + tuple(sorted(kwds.items()))
-#                 with lock:
-                try:
-                    result = cache[key]
-                    cache_renew(key)    # record recent use of this key
-                    return result
-                except KeyError:
-                    pass
+                with lock:
+                    try:
+                        result = cache[key]
+                        cache_renew(key)    # record recent use of this key
+                        return result
+                    except KeyError:
+                        pass
 
                 result = user_function(*args, **kwds)
-#                 with lock:
-                cache[key] = result     # record recent use of this key
-                if len(cache) > maxsize:
-                    cache_popitem(0)    # purge least recently used cache entry
+                with lock:
+                    cache[key] = result     # record recent use of this key
+                    if len(cache) > maxsize:
+                        cache_popitem(0)    # purge least recently used cache
+                                            # entry
 
                 return result
 
         def cache_clear():
             """Clear the cache and cache statistics"""
-#             with lock:
-            cache.clear()
+            with lock:
+                cache.clear()
 
         wrapper.cache_clear = cache_clear
         return wrapper
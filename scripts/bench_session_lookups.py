@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+#
+# Use this script to measure how fast turn and transcription lookups in
+# a session XML file are.  It generates a session with 200 user turns in
+# a temporary directory and reports lookups per second for three ways of doing
+# each lookup:
+#
+#   before -- the original XMLSession methods, copied verbatim into the
+#       `old_*' functions below (they format a path string and evaluate it from
+#       the root for each lookup);
+#   compiled XPath -- XPath expressions compiled once and evaluated from the
+#       root for each lookup, without the index of user turns;
+#   after -- the current XMLSession methods, which look turns up in the index
+#       of user turns built on the first turn lookup and use compiled XPath
+#       expressions within the turn.  (iter_transcriptions does not use the
+#       index, so its "after" figure measures compiled XPath alone.)
+#
+# Usage: bench_session_lookups.py [N_TURNS]
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import timeit
+
+# Update the Python path, then do some more imports.
+_script_dir = os.path.realpath(os.path.dirname(__file__))
+_site_dir = os.path.realpath(os.path.join(_script_dir, os.pardir, 'trs_site'))
+_app_dir = os.path.realpath(os.path.join(_script_dir, os.pardir,
+                                         'transcription'))
+
+for _dir in (_app_dir, _site_dir):
+    if _dir not in sys.path:
+        sys.path.insert(0, _dir)
+
+from lxml import etree
+
+from session_xml import XMLSession
+
+# Stand-ins for the Django objects that XMLSession methods look at.
+_User = namedtuple('_User', ['username'])
+_DgAnn = namedtuple('_DgAnn', ['pk', 'user'])
+_Turn = namedtuple('_Turn', ['turn_number'])
+_Trs = namedtuple('_Trs', ['turn', 'dialogue_annotation'])
+
+
+def write_session(fname, n_turns):
+    """Writes a session XML file in the `dialog' scheme."""
+    with open(fname, 'w') as sess_file:
+        sess_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<dialog>\n')
+        for turn_number in xrange(1, n_turns + 1):
+            sess_file.write(
+                '<systurn turnnum="{t}"><prompt>Hello.</prompt></systurn>\n'
+                '<userturn turnnum="{t}"><rec fname="{t}.wav"/>'
+                '<transcriptions><transcription annotation="1" author="">'
+                'hi {t}</transcription></transcriptions>'
+                '<asr><asrhyp prob="0.9">hi {t}</asrhyp>'
+                '<asrhyp prob="0.1">bye {t}</asrhyp></asr>'
+                '<semi><semihyp prob="0.9">hello()</semihyp></semi>'
+                '</userturn>\n'.format(t=turn_number))
+        sess_file.write('<annotations><annotation id="1" user=""/>'
+                        '</annotations>\n</dialog>\n')
+
+
+def old_find_transcription(self, trs):
+    """`XMLSession.find_transcription' as it used to be."""
+    dg_ann = trs.dialogue_annotation
+    if dg_ann.user is not None:
+        username = dg_ann.user.username
+    else:
+        username = ''
+    trs_path = ("{uturn}[@{turn_attr}='{turn}']{trss}/{trs}"
+                "[@{auth_attr}='{author}'][@{ann_attr}='{ann}']").format(
+                    uturn=self.USERTURN_PATH,
+                    turn_attr=self.TURNNUMBER_ATTR,
+                    turn=str(trs.turn.turn_number),
+                    trss=self.SLASH_TRANSCRIPTIONS_ELEM,
+                    trs=self.TRANSCRIPTION_ELEM,
+                    auth_attr=self.AUTHOR_ATTR,
+                    author=username,
+                    ann_attr="annotation",  # hard-wired in views.py, too
+                    ann=str(dg_ann.pk))
+    return self.sess_xml.find(trs_path)
+
+
+def old_find_asr_1best_for_turn(self, turn_number):
+    """`XMLSession.find_asr_1best_for_turn' as it used to be."""
+
+    # Find all enclosing ASR hypothesis elements (the ASR hypotheses are
+    # split over several such sometimes).
+    asrs_path = "{uturn}[@{turn_attr}='{turn}']{asrs}".format(
+        uturn=self.USERTURN_PATH,
+        turn_attr=self.TURNNUMBER_ATTR,
+        turn=str(turn_number),
+        asrs=self.SLASH_ASRHYPS_ELEM)
+    asrs_els = self.sess_xml.findall(asrs_path)
+    if not asrs_els:
+        return None
+
+    asr_subhyps = list()
+    for asrs_el in asrs_els:
+        asr_els = asrs_el.findall(self.ASRHYP_ELEM)
+        if not asr_els:
+            continue
+        # Be robust against invalid asrhyp elements.
+        try:
+            best_asr = max((el.get(self.PROB_ATTR), el) for el in asr_els)[1]
+            asr_subhyps.append(best_asr.text.strip())
+        except:
+            continue
+    return ' '.join(asr_subhyps)
+
+
+def old_iter_transcriptions(self, annotation):
+    """`XMLSession.iter_transcriptions' as it used to be."""
+
+    # Prepare for iteration.
+    ann_id = annotation.get('id')
+    trs_subpath = ".{trss}/{trs}[@{ann_attr}='{ann}']".format(
+        trss=self.SLASH_TRANSCRIPTIONS_ELEM,
+        trs=self.TRANSCRIPTION_ELEM,
+        ann_attr="annotation",  # hard-wired in views.py, too
+        ann=ann_id)
+
+    # Iterate user turns and yield their respective transcriptions.
+    for uturn_el in self.sess_xml.iterfind(self.USERTURN_PATH):
+        try:
+            turn_number = int(uturn_el.get(self.TURNNUMBER_ATTR, -1))
+        except TypeError:
+            # Some turns in the XML logs don't have the turn number
+            # attribute, which leads to a TypeError. Skip such turns.
+            continue
+        # Find transcriptions in this turn (assumably, there will be
+        # one, but there may be none).
+        for trs in uturn_el.iterfind(trs_subpath):
+            yield turn_number, trs
+
+
+class CompiledLookups(object):
+    """
+    Lookups of user turns by their number done with XPath expressions
+    compiled once and evaluated from the root, without the index of user
+    turns.
+
+    """
+
+    def __init__(self, session):
+        self.session = session
+        uturn_path = "{uturn}[@{turn_attr}=$turn]".format(
+            uturn=session.USERTURN_PATH, turn_attr=session.TURNNUMBER_ATTR)
+        self.trs_xpath = etree.XPath(
+            "{uturn}{trss}/{trs}[@{author}=$author][@annotation=$ann]".format(
+                uturn=uturn_path, trss=session.SLASH_TRANSCRIPTIONS_ELEM,
+                trs=session.TRANSCRIPTION_ELEM, author=session.AUTHOR_ATTR))
+        self.asrs_xpath = etree.XPath(uturn_path + session.SLASH_ASRHYPS_ELEM)
+
+    def find_transcription(self, trs):
+        dg_ann = trs.dialogue_annotation
+        username = dg_ann.user.username if dg_ann.user is not None else ''
+        trs_els = self.trs_xpath(self.session.sess_xml,
+                                 turn=str(trs.turn.turn_number),
+                                 author=username, ann=str(dg_ann.pk))
+        return trs_els[0] if trs_els else None
+
+    def find_asr_1best_for_turn(self, turn_number):
+        session = self.session
+        asrs_els = self.asrs_xpath(session.sess_xml, turn=str(turn_number))
+        if not asrs_els:
+            return None
+        asr_subhyps = list()
+        for asrs_el in asrs_els:
+            asr_els = session.asrhyp_xpath(asrs_el)
+            if asr_els:
+                best_asr = max((el.get(session.PROB_ATTR), el)
+                               for el in asr_els)[1]
+                asr_subhyps.append(best_asr.text.strip())
+        return ' '.join(asr_subhyps)
+
+
+def measure(label, func, n_lookups, repeat=3):
+    secs = min(timeit.repeat(func, number=1, repeat=repeat))
+    print '{label:<42} {rate:>12.0f} lookups/s'.format(
+        label=label, rate=n_lookups / secs)
+
+
+def main(n_turns=200):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sess_fname = os.path.join(tmp_dir, 'session.xml')
+        write_session(sess_fname, n_turns)
+        turn_numbers = range(1, n_turns + 1)
+        dg_ann = _DgAnn(1, _User(''))
+        trss = [_Trs(_Turn(turn_number), dg_ann)
+                for turn_number in turn_numbers]
+
+        with XMLSession(fname=sess_fname, mode='r') as session:
+            print 'Session with {n} user turns.'.format(n=n_turns)
+            compiled = CompiledLookups(session)
+            measure('find_transcription (before)',
+                    lambda: [old_find_transcription(session, trs)
+                             for trs in trss],
+                    n_turns)
+            measure('find_transcription (compiled XPath)',
+                    lambda: map(compiled.find_transcription, trss),
+                    n_turns)
+            measure('find_transcription (after)',
+                    lambda: map(session.find_transcription, trss),
+                    n_turns)
+            measure('find_asr_1best_for_turn (before)',
+                    lambda: [old_find_asr_1best_for_turn(session, turn_number)
+                             for turn_number in turn_numbers],
+                    n_turns)
+            measure('find_asr_1best_for_turn (compiled XPath)',
+                    lambda: map(compiled.find_asr_1best_for_turn,
+                                turn_numbers),
+                    n_turns)
+            measure('find_asr_1best_for_turn (after)',
+                    lambda: map(session.find_asr_1best_for_turn,
+                                turn_numbers),
+                    n_turns)
+            ann_el = next(session.iter_annotations())
+            measure('iter_transcriptions (before)',
+                    lambda: list(old_iter_transcriptions(session, ann_el)),
+                    n_turns)
+            measure('iter_transcriptions (after)',
+                    lambda: list(session.iter_transcriptions(ann_el)),
+                    n_turns)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
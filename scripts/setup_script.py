@@ -82,6 +82,9 @@ def make_dirs(stngs):
     dirnames = [stngs.EXPORT_DIR,
                 stngs.CONVERSATION_DIR,
                 stngs.LISTS_DIR]
+    # Add the annotation index dirname, if applicable.
+    if getattr(stngs, 'ANN_INDEX_DIR', None):
+        dirnames.append(stngs.ANN_INDEX_DIR)
     # Add the database dirname ('db'), if applicable.
     try:
         if (stngs.DATABASES['default']['ENGINE'] ==
@@ -11,15 +11,15 @@ import shutil
 
 from django import forms
 from django.contrib import admin, messages
-from django.db import models
+from django.db import models, transaction
 # from django.db.models import Count
 from django.shortcuts import render
 
-from session_xml import update_worker_cers, XMLSession
+from session_xml import batched_sessions, update_worker_cers, XMLSession
 import settings
 from transcription.crowdflower import price_class_handler
 if settings.USE_CF:
-    from transcription.crowdflower import JsonDialogueUpload, update_gold
+    from transcription.crowdflower import JsonDialogueUpload, update_golds
 from transcription.db_fields import SizedTextField, ROCharField
 from transcription.dg_util import update_price
 from transcription.form_fields import LinkField
@@ -213,6 +213,9 @@ class DialogueAdmin(admin.ModelAdmin):
         for dg in queryset:
             dg_dir = os.path.join(settings.CONVERSATION_DIR, dg.cid)
             tgt_dg_dir = os.path.join(tgt_dir, dg.dirname)
+            # Audio files may be symbolic links to the original recordings
+            # (see `import_dialogues').  copytree copies the files they point
+            # to, so the recordings themselves get exported.
             shutil.copytree(dg_dir, tgt_dg_dir)
         # Output a message to the user.
         self.message_user(request,
@@ -262,8 +265,8 @@ class DialogueAdmin(admin.ModelAdmin):
 
     if settings.USE_CF:
         def update_gold_action(modeladmin, request, queryset):
-            for dg in queryset:
-                success, msg = update_gold(dg)
+            dgs = list(queryset)
+            for dg, (success, msg) in zip(dgs, update_golds(dgs)):
                 if success:
                     modeladmin.message_user(
                         request,
@@ -538,14 +541,16 @@ class DialogueAnnotationAdmin(admin.ModelAdmin):
         n_changed = [0, 0]  # to not breaks, to breaks
 
         dgs = queryset.values_list('dialogue', flat=True).distinct()
-        for dg in dgs:
-            n_trss_changed = modeladmin._update_gold_statuses(
-                dg, Transcription, trss_match)
-            n_anns_changed = modeladmin._update_gold_statuses(
-                dg, SemanticAnnotation, das_match)
-            # XXX Here we are losing information whether transcriptions or
-            # semantic annotations were changed.
-            n_changed = map(sum, zip(n_trss_changed, n_anns_changed))
+        # Write the session files only once the changes are committed.
+        with batched_sessions(), transaction.commit_on_success():
+            for dg in dgs:
+                n_trss_changed = modeladmin._update_gold_statuses(
+                    dg, Transcription, trss_match)
+                n_anns_changed = modeladmin._update_gold_statuses(
+                    dg, SemanticAnnotation, das_match)
+                # XXX Here we are losing information whether transcriptions
+                # or semantic annotations were changed.
+                n_changed = map(sum, zip(n_trss_changed, n_anns_changed))
 
         msg = ('{n} transcriptions had their gold breaking status changed, '
                '{good} to OK, {bad} to gold-breaking.').format(
@@ -603,8 +608,7 @@ class DialogueAnnotationAdmin(admin.ModelAdmin):
     if settings.USE_CF:
         def update_gold_action(modeladmin, request, queryset):
             dialogues = set(dg_ann.dialogue for dg_ann in queryset)
-            for dialogue in dialogues:
-                success, _ = update_gold(dialogue)
+            for success, _ in update_golds(dialogues):
                 if not success:
                     raise ValueError()
 
@@ -635,9 +639,11 @@ class AbstractTranscriptionAdmin(admin.ModelAdmin):
                    'dialogue_annotation__date_paid']
 
     def toggle_gold(modeladmin, request, queryset):
-        for trs in queryset:
-            trs.is_gold = not trs.is_gold
-            trs.save()
+        # Write the session files only once the changes are committed.
+        with batched_sessions(), transaction.commit_on_success():
+            for trs in queryset:
+                trs.is_gold = not trs.is_gold
+                trs.save()
 
     toggle_gold.short_description = "Toggle gold status"
 
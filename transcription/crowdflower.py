@@ -1,24 +1,30 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
-from collections import Sequence
+from collections import Counter, Sequence
 import cStringIO as StringIO
 import csv
-import httplib
+from email.utils import mktime_tz, parsedate_tz
 import json
 from lru_cache import lru_cache
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
+import random
 import re
+import tempfile
+from threading import Lock
 import time
 from urllib import urlencode
-import urllib2
 import zipfile
 
+from django.db import transaction
+
 import settings
 
 from dg_util import is_gold
+from http_pool import ConnectionPool
 if settings.USE_CF:
-    from models import CrowdflowerJob
+    from models import CrowdflowerJob, JudgmentCursor, WorkerGoldStats
 else:
     from models import PriceClass
 from settings import SettingsException
@@ -26,7 +32,7 @@ from session_xml import XMLSession, record_judgments, update_worker_stats
 from transcription.models import UserTurn
 from util import get_log_path
 
-CF_URL_START = "https://api.crowdflower.com"
+CF_URL_START = settings.CF_URL
 HOOKNAMES2CSVNAMES = {
     "city": "_city",
     "region": "_region",
@@ -50,20 +56,106 @@ try:
     _LOG_CURL = settings.LOG_CURL
 except AttributeError:
     _LOG_CURL = False
+# Connections to Crowdflower kept open for subsequent requests.
+_cf_pool = ConnectionPool(max_per_host=settings.CF_MAX_CONNECTIONS)
+
+
+class _TokenBucket(object):
+    """
+    A rate limiter that lets through `rate' calls per second on average, and
+    bursts of at most `burst' calls.  It is thread-safe.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = Lock()
+
+    def take(self):
+        """Blocks until another call is allowed."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.:
+                    self._tokens -= 1.
+                    return
+                wait_secs = (1. - self._tokens) / self.rate
+            time.sleep(wait_secs)
+
+
+class CrowdflowerExecutor(object):
+    """
+    Runs independent calls to Crowdflower concurrently, in a pool of threads.
+    Requests themselves are rate-limited in `_contact_cf'.
+
+    The functions run should not touch the database, as each thread would
+    open its own connection to it.  Find out what is needed from the database
+    before.
+
+    """
+
+    def __init__(self, n_threads):
+        self.n_threads = n_threads
+
+    def map(self, func, items):
+        """
+        Calls `func' on each of `items' concurrently.
+
+        Arguments:
+            func -- a function returning a tuple (success?, message)
+            items -- arguments to call `func' on
+
+        Returns a list of what `func' returned for each of `items', in the
+        same order.  An exception raised by `func' is turned into
+        a (False, message) tuple.
+
+        """
+        items = list(items)
+        if not items:
+            return list()
+
+        def call(item):
+            try:
+                return func(item)
+            except Exception as ex:
+                return False, unicode(ex)
+
+        if self.n_threads <= 1 or len(items) == 1:
+            return map(call, items)
+        pool = ThreadPool(min(self.n_threads, len(items)))
+        try:
+            return pool.map(call, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+
+# Limits the rate of requests to Crowdflower from all threads together.
+_cf_rate_limiter = (None if settings.CF_REQUESTS_PER_SEC is None
+                    else _TokenBucket(settings.CF_REQUESTS_PER_SEC,
+                                      settings.CF_REQUESTS_BURST))
+cf_executor = CrowdflowerExecutor(settings.CF_MAX_CONNECTIONS)
 
 
 class CrowdflowerMessage(object):
-    def __init__(self, status, obj=None, content_type='json'):
+    def __init__(self, status, obj=None, content_type='json', headers=None):
         """
         Arguments:
             status -- the HTTP response status
             obj -- parsed object returned by Crowdflower or None
             content_type -- either 'json' or 'csv'
+            headers -- a mapping of response headers (with lowercased names)
 
         """
         self.status = status
         self.obj = obj
         self.content_type = content_type
+        self.headers = headers or dict()
 
 
 class CrowdflowerException(Exception):
@@ -75,9 +167,134 @@ class CrowdflowerException(Exception):
             self.er_msgs = er_msgs
 
 
+def _retry_after(cf_msg):
+    """
+    Returns the number of seconds Crowdflower asked us to wait before the next
+    request in the Retry-After header of `cf_msg', or None if it did not.
+    """
+    value = cf_msg.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0., mktime_tz(date) - time.time())
+
+
+class _RetryPolicy(object):
+    """
+    Decides when to repeat requests to Crowdflower.  Requests are repeated
+    after exponentially growing waits with random jitter, unless Crowdflower
+    says how long to wait in a Retry-After header, until they succeed, fail
+    with a status that means repeating them would not help, or until
+    a deadline passes.
+
+    Counts of repeated requests and of their outcomes are kept in `counts'.
+
+    """
+    # Statuses that mean the request may succeed if repeated later.
+    RETRYABLE_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+    def __init__(self, initial_secs, max_secs, max_tries, deadline_secs):
+        """
+        Arguments:
+            initial_secs -- how long to wait before the first repetition at
+                most, in seconds
+            max_secs -- how long to wait between two requests at most, in
+                seconds
+            max_tries -- how many times to make a request at most
+            deadline_secs -- how long to keep repeating a request at most, in
+                seconds
+
+        """
+        self.initial_secs = initial_secs
+        self.max_secs = max_secs
+        self.max_tries = max_tries
+        self.deadline_secs = deadline_secs
+        self._lock = Lock()
+        # :: {outcome -> count}, where outcome is 'retried' or 'retried_<HTTP
+        #                        status>', 'succeeded_after_retry', 'fatal',
+        #                        or 'gave_up'
+        self.counts = Counter()
+
+    def _count(self, *outcomes):
+        with self._lock:
+            for outcome in outcomes:
+                self.counts[outcome] += 1
+
+    def get_counts(self):
+        """Returns a snapshot of the retry counters as a dictionary."""
+        with self._lock:
+            return dict(self.counts)
+
+    def _wait_secs(self, n_tries, cf_msg):
+        retry_after = _retry_after(cf_msg)
+        if retry_after is not None:
+            return retry_after
+        # "Full jitter": wait a random time up to the exponential bound.
+        return random.uniform(0, min(self.max_secs,
+                                     self.initial_secs * 2 ** n_tries))
+
+    def call(self, func, done=None, retry_statuses=()):
+        """
+        Calls `func' until it succeeds.
+
+        Arguments:
+            func -- a function of no arguments that returns
+                a CrowdflowerMessage or raises a CrowdflowerException (like
+                `_contact_cf')
+            done -- a predicate on what `func' returned that says whether
+                the request has succeeded; if not, the request is repeated
+                (default: any message returned counts as a success)
+            retry_statuses -- HTTP statuses, other than the generally
+                retryable ones, that should cause the request to be repeated
+
+        Returns a tuple (success?, CrowdflowerMessage or error message).
+
+        """
+        deadline = time.time() + self.deadline_secs
+        error_msg = 'Timed out when waiting for Crowdflower.'
+        for n_tries in xrange(self.max_tries):
+            try:
+                cf_msg = func()
+            except CrowdflowerException as cex:
+                cf_msg = cex.cf_msg
+                # No status means no response has arrived at all.
+                if not (cf_msg.status is None
+                        or cf_msg.status in self.RETRYABLE_STATUSES
+                        or cf_msg.status in retry_statuses):
+                    self._count('fatal')
+                    return False, '\n'.join(cex.er_msgs)
+                error_msg = '\n'.join(cex.er_msgs)
+            else:
+                if done is None or done(cf_msg):
+                    if n_tries:
+                        self._count('succeeded_after_retry')
+                    return True, cf_msg
+            if n_tries + 1 == self.max_tries:
+                break
+            wait_secs = self._wait_secs(n_tries, cf_msg)
+            if time.time() + wait_secs > deadline:
+                break
+            self._count('retried',
+                        'retried_{status}'.format(status=cf_msg.status))
+            time.sleep(wait_secs)
+        self._count('gave_up')
+        return False, error_msg
+
+
+cf_retry_policy = _RetryPolicy(settings.CF_WAIT_SECS,
+                               settings.CF_MAX_WAIT_SECS,
+                               settings.CF_MAX_WAITS,
+                               settings.CF_RETRY_DEADLINE_SECS)
+
+
 def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
                 verb=None, log=_LOG_CURL, headers=None, out_zipped=False,
-                out_enc='UTF-8'):
+                out_enc='UTF-8', out_file=None):
     """
 
     Arguments:
@@ -96,14 +313,15 @@ def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
         out_enc -- name of the encoding the output object is assumed to have;
             default: None (no decoding is attempted, the string is returned
             verbatim)
+        out_file -- a file to write the output to, replacing its contents,
+            if it should not be kept in memory.  The output is then left
+            unprocessed, and the `obj' of the message returned is None.
 
     """
 
     # Default the verb to GET or POST, depending on the presence of data.
     if verb is None:
         verb = 'GET' if data is None else 'POST'
-    use_urllib2 = (verb in ('GET', 'POST') and type_ours == 'data'
-                   and headers is None)
 
     # Initialisation.
     error_msgs = list()
@@ -145,42 +363,22 @@ def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
                                                   ext=type_theirs,
                                                   key=settings.CF_KEY)
 
-    # Make the connection, retrieve results.
-    # Special case: use urllib2 when possible.
+    # Send the request through a kept-alive connection, retrieve results.
     cf_out = None
-    cf_res = None
-    if use_urllib2:
-        try:
-            cf_url_whole = CF_URL_START + cf_url
-            cf_res = urllib2.urlopen(cf_url_whole, data_str or None)
-        except urllib2.HTTPError as er:
-            status = er.code
-            reason = er.msg
-        else:
-            status = 200
-            reason = 'OK'
-        try:
-            cf_out = cf_res.read()
-        except Exception as ex:
-            error_msgs.append(unicode(ex))
-            serious_errors = True
-    # General case: use httplib.
-    else:
-        try:
-            cf_conn = httplib.HTTPSConnection('api.crowdflower.com')
-        except:
-            cf_conn = httplib.HTTPConnection('api.crowdflower.com')
-        try:
-            cf_conn.request(verb, cf_url, data_str, headers_final)
-            cf_res = cf_conn.getresponse()
-            status = cf_res.status
-            reason = cf_res.reason
-            cf_out = cf_res.read()
-        except Exception as ex:
-            error_msgs.append(unicode(ex))
-            serious_errors = True
-        finally:
-            cf_conn.close()
+    status = reason = None
+    res_headers = dict()
+    if _cf_rate_limiter is not None:
+        _cf_rate_limiter.take()
+    if out_file is not None:
+        out_file.seek(0)
+        out_file.truncate()
+    try:
+        status, reason, res_headers, cf_out = _cf_pool.request(
+            verb, CF_URL_START + cf_url, data_str or None, headers_final,
+            out_file=out_file)
+    except Exception as ex:
+        error_msgs.append(unicode(ex))
+        serious_errors = True
 
     # Run through character decoding if asked to.
     if out_enc is not None and cf_out is not None:
@@ -201,7 +399,7 @@ def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
                                      headers=headers_str, status=status,
                                      reason=reason)
         try:
-            msg += cf_out + '\n'
+            msg += (cf_out or '') + '\n'
         except UnicodeEncodeError:
             try:
                 msg = str(msg) + cf_out + '\n'
@@ -216,7 +414,8 @@ def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
     # Process the Crowdflower response.
     try:
         # Unzip if asked to.
-        if out_zipped:
+        # (If the output was written to `out_file', cf_out is None.)
+        if out_zipped and cf_out is not None:
             try:
                 zip_contents = zipfile.ZipFile(StringIO.StringIO(cf_out))
                 with zip_contents.open(zip_contents.infolist()[0]) as zip_file:
@@ -260,61 +459,112 @@ def _contact_cf(cf_url_part, data=None, type_ours='data', type_theirs='json',
                '{msg}').format(code=status, reason=reason, msg=cf_out or '')
         error_msgs.append(msg)
         # In case of lack of success, raise an informative exception.
-        cf_msg = CrowdflowerMessage(status=status, obj=cf_outobj)
+        cf_msg = CrowdflowerMessage(status=status, obj=cf_outobj,
+                                    headers=res_headers)
         raise CrowdflowerException(cf_msg=cf_msg, er_msgs=error_msgs)
 
     # Return the returned object in case of success.
-    cf_msg = CrowdflowerMessage(status=status, obj=cf_outobj)
+    cf_msg = CrowdflowerMessage(status=status, obj=cf_outobj,
+                                headers=res_headers)
     return cf_msg
 
 
 def _wait_for_cf(*args, **kwargs):
     """Calls _contact_cf as long as the response is not 200 OK.
 
-    Keyword arguments:
-        max_waits -- maximum number of tries to contact Crowdflower (and get
-            the 200 OK response)
-        wait_secs -- number of seconds between subsequent tries
-        other arguments -- will be passed on to _contact_cf
+    The request is repeated as `cf_retry_policy' says.  All arguments are
+    passed on to _contact_cf.
+
+    Returns a tuple (success?, CrowdflowerMessage or error message).
 
     """
+    return cf_retry_policy.call(lambda: _contact_cf(*args, **kwargs),
+                                done=lambda cf_msg: cf_msg.status == 200)
 
-    # Interpret the arguments.
-    max_waits = kwargs.get('max_waits', settings.CF_MAX_WAITS)
-    wait_secs = kwargs.get('wait_secs', settings.CF_WAIT_SECS)
 
-    # Wait for an OK response from CF.
-    for _ in xrange(max_waits):
+class JobReport(object):
+    """
+    A full report for a job from Crowdflower, zipped in a temporary file.
+    Iterating over the report reads its rows (lists of strings, not including
+    the header) one by one from the file.
+
+    Attributes:
+        header -- the list of column names
+        columns -- a mapping {column name -> index in a row}
+
+    """
+
+    def __init__(self, report_file):
+        """
+        Arguments:
+            report_file -- a file with the zipped CSV report; it is closed
+                when the report is
+
+        Raises zipfile.BadZipfile or ValueError if the file does not contain
+        a report.
+
+        """
+        self._file = report_file
+        self._file.seek(0)
+        self._zip = zipfile.ZipFile(self._file)
         try:
-            cf_msg = _contact_cf(*args, **kwargs)
-        except CrowdflowerException as cex:
-            return False, '\n'.join(cex.er_msgs)
-        else:
-            if str(cf_msg.status) != '200':
-                time.sleep(wait_secs)
-                continue
-            else:
-                return True, cf_msg
-    else:
-        msg = 'Timed out when waiting for Crowdflower.'
-        return False, msg
+            members = self._zip.infolist()
+            if not members:
+                raise ValueError('The report archive is empty.')
+            self._member = members[0]
+            with self._zip.open(self._member) as csv_file:
+                self.header = next(csv.reader(csv_file), None)
+            if self.header is None:
+                raise ValueError('The report has no header.')
+        except:
+            self.close()
+            raise
+        self.columns = {name: idx for idx, name in enumerate(self.header)}
+
+    def __iter__(self):
+        with self._zip.open(self._member) as csv_file:
+            rows = csv.reader(csv_file)
+            next(rows)  # Skip the header.
+            for row in rows:
+                yield row
+
+    def close(self):
+        self._zip.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def _get_job_report(job_id):
+    """
+    Downloads the full report for a job from Crowdflower.
+
+    Returns a tuple (success?, JobReport or error message).
+
+    """
     cf_url = 'jobs/{jobid}'.format(jobid=job_id)
+    report_file = tempfile.TemporaryFile()
 
     # Wait for an OK response from CF.
     success, msg = _wait_for_cf(cf_url, type_theirs='csv', out_zipped=True,
-                                out_enc=None)
+                                out_enc=None, out_file=report_file)
     # Process the response -- exceptions.
     if not success:
+        report_file.close()
         return False, msg
-    if msg.obj is None:
+    try:
+        report = JobReport(report_file)
+    except (zipfile.BadZipfile, ValueError):
+        report_file.close()
         msg = 'No judgments reported by Crowdflower.'
         return False, msg
 
-    # In case of success, return the message.
-    return True, msg
+    # In case of success, return the report.
+    return True, report
 
 
 def _cf_json_getitem(cf_json, key, deser=True):
@@ -473,6 +723,29 @@ def list_units(job_id):
         return True, unit_dict
 
 
+def _wait_for_units(job_id, cids):
+    """
+    Waits until Crowdflower lists units for all of `cids' in the job.
+
+    Returns a tuple (success?, CrowdflowerMessage or error message).
+
+    """
+    cids = set(cids)
+    cf_url = 'jobs/{jobid}/units'.format(jobid=job_id)
+
+    def has_all_units(cf_msg):
+        listed_cids = set(unit['cid']
+                          for unit in (cf_msg.obj or dict()).itervalues())
+        return cids <= listed_cids
+
+    success, msg = cf_retry_policy.call(lambda: _contact_cf(cf_url),
+                                        done=has_all_units)
+    # Do not keep the listing from before the units showed up.
+    list_units.cache_clear()
+    unit_id_from_cid.cache_clear()
+    return success, msg
+
+
 def fire_gold_hooks(job_id):
     cf_url = 'jobs/{job_id}/golds/fire_webhooks'.format(job_id=job_id)
     try:
@@ -700,19 +973,17 @@ def cancel_job(jobid):
 def delete_job(jobid, force_delete_from_db=True):
     # Try to cancel the job in case it is running.
     success, msgs = cancel_job(jobid)
-    if success:
-        time.sleep(settings.CF_WAIT_SECS)
 
-    # Delete the job from Crowdflower.
+    # Delete the job from Crowdflower.  Crowdflower may refuse to delete
+    # a job that is just being canceled, so retry on conflicts too.
     cf_url = 'jobs/{jobid}'.format(jobid=jobid)
-    try:
-        cf_msg = _contact_cf(cf_url, verb='DELETE')
-    except CrowdflowerException as cex:
-        success = False
-        ret_msg = '\n'.join(cex.er_msgs)
-    else:
-        success = True
+    success, cf_msg = cf_retry_policy.call(
+        lambda: _contact_cf(cf_url, verb='DELETE'),
+        retry_statuses=((409, 422) if success else ()))
+    if success:
         ret_msg = cf_msg.obj or ''
+    else:
+        ret_msg = cf_msg
 
     # Delete job from the job IDs file.
     if success or force_delete_from_db:
@@ -726,13 +997,14 @@ def delete_job(jobid, force_delete_from_db=True):
     return success, ret_msg
 
 
-def update_gold(dg, job_id=None):
+def update_gold(dg, job_id=None, dg_is_gold=None):
     """Updates the gold status of `dg' on Crowdflower.
 
     Arguments:
         dg -- the Dialogue object for the dialogue
         job_id -- if another job ID than the one computed for `dg' by the price
             class handler should be used, specify it here
+        dg_is_gold -- whether `dg' is gold, if known already
 
     """
     job_id = job_id or price_class_handler.get_job_id(dg)
@@ -741,7 +1013,8 @@ def update_gold(dg, job_id=None):
         msg = unit_pair
         return False, msg
     unit_id, unit = unit_pair
-    dg_is_gold = is_gold(dg)
+    if dg_is_gold is None:
+        dg_is_gold = is_gold(dg)
     if dg_is_gold != (unit['state'] == 'golden'):
         success, errors = update_unit(
             job_id, unit_id,
@@ -751,6 +1024,28 @@ def update_gold(dg, job_id=None):
     return True, None
 
 
+def update_golds(dgs, job_id=None):
+    """Updates the gold status of many dialogues on Crowdflower concurrently.
+
+    Arguments:
+        dgs -- an iterable of Dialogue objects
+        job_id -- if another job ID than the one computed for each of `dgs' by
+            the price class handler should be used, specify it here
+
+    Returns a list of tuples (success?, message), one for each dialogue (see
+    `update_gold').
+
+    """
+    dgs = list(dgs)
+    # Find out what is needed from the database here, in this thread.
+    job_ids = [job_id or price_class_handler.get_job_id(dg) for dg in dgs]
+    dg_golds = [is_gold(dg) for dg in dgs]
+    # List units of each job once, before asking about them concurrently.
+    cf_executor.map(list_units, set(job_ids))
+    return cf_executor.map(lambda args: update_gold(*args),
+                           zip(dgs, job_ids, dg_golds))
+
+
 def record_worker(post_dict):
     """
     Records worker information to the corresponding session XML file based
@@ -860,68 +1155,123 @@ def create_dialogue_csv(dg):
                                         gold=dg.get_code_gold())
 
 
-def collect_judgments(job_id):
+def collect_judgments(job_id, report=None):
     """Downloads a CSV of all judgments for a job from Crowdflower.
 
     Downloads a CSV of all judgments for a job from Crowdflower and updates
-    workers' gold ratio statistics in session XML files.
+    workers' gold ratio statistics in session XML files.  Only judgments not
+    collected before are counted, and only workers who have made any of them
+    have their statistics updated.  The counts are committed before the
+    session files get updated; workers whose statistics could not be
+    recorded in the files are updated again at the next collection.
 
     Arguments:
         job_id -- Crowdflower job ID for the job in question
+        report -- what `_get_job_report' returned for the job, if it has been
+            downloaded already.  The report is closed when done with.
 
     Returns a tuple (success?, reason).
 
     """
 
-    success, msg = _get_job_report(job_id)
+    success, report = report or _get_job_report(job_id)
     if not success:
-        return False, msg
-
-    # Divide the first row as a CSV header.
-    header = msg.obj[0]
-    recs = msg.obj[1:]
-
-    # Prepare for counting gold/missed items.
-    gold_stats = dict()  # :: {worker_id -> [n_missed, n_gold]}
-    header_dic = {name: idx for idx, name in enumerate(header)}
-    worker_idx = header_dic['_worker_id']
-    golden_idx = header_dic['_golden']
-    missed_idx = header_dic['_missed']
-
-    # Count gold/missed items per worker.
-    for rec in recs:
-        worker = rec[worker_idx]
-        worker_stats = gold_stats.setdefault(worker, [0, 0])
-        if rec[golden_idx] == 'true':
-            worker_stats[1] += 1
-            worker_stats[0] += int(rec[missed_idx] == 'true')
-
-    # Compute workers' scores.
-    # Gold score shall be the ratio of golden items the worker got right to all
-    # gold items he/she attempted. If the worker attempted no gold items, it is
-    # set to -1.0.
-    # (Redefining gold_stats :: {worker_id -> [n_missed, n_gold, gold_score]}.)
-    for worker_id, worker_stats in gold_stats.iteritems():
-        n_missed, n_gold = worker_stats
-        if n_missed == n_gold == 0:
-            gold_score = -1.
-        else:
-            gold_score = 1. - float(n_missed) / n_gold
-        worker_stats.append(gold_score)
-
-    # Record the gold statistics in XML session files.
-    # (Redefining gold_stats :: {worker_id -> gold_score}.)
-    gold_stats = {worker_id: stats[2]
-                  for worker_id, stats in gold_stats.iteritems()}
-    n_files, n_anns = update_worker_stats(gold_stats)
+        return False, report
+
+    with report, transaction.commit_on_success():
+        # Lock the job's cursor so that no judgments get counted twice.
+        JudgmentCursor.objects.get_or_create(job_id=job_id)
+        cursor = JudgmentCursor.objects.select_for_update().get(job_id=job_id)
+
+        # Prepare for counting gold/missed items.
+        new_stats = dict()  # :: {worker_id -> [n_missed, n_gold]}
+        id_idx = report.columns['_id']
+        worker_idx = report.columns['_worker_id']
+        golden_idx = report.columns['_golden']
+        missed_idx = report.columns['_missed']
+
+        # Count gold/missed items per worker in judgments new since the last
+        # collection.
+        last_judgment_id = cursor.last_judgment_id
+        n_judgments = 0
+        for rec in report:
+            judgment_id = int(rec[id_idx])
+            if judgment_id <= cursor.last_judgment_id:
+                continue
+            n_judgments += 1
+            last_judgment_id = max(last_judgment_id, judgment_id)
+            worker = rec[worker_idx]
+            worker_stats = new_stats.setdefault(worker, [0, 0])
+            if rec[golden_idx] == 'true':
+                worker_stats[1] += 1
+                worker_stats[0] += int(rec[missed_idx] == 'true')
+
+        # Add the new counts to the running ones, and mark the workers for
+        # having their scores recorded in session logs.  (Workers'
+        # annotations made since the last collection need it even if their
+        # score has not changed.)
+        worker_stats_objs = {
+            worker_stats.worker_id: worker_stats for worker_stats in
+            WorkerGoldStats.objects.filter(job_id=job_id)}
+        for worker_id, (n_missed, n_gold) in new_stats.iteritems():
+            worker_stats = worker_stats_objs.get(worker_id)
+            if worker_stats is None:
+                worker_stats = WorkerGoldStats(job_id=job_id,
+                                               worker_id=worker_id)
+            if n_gold or not worker_stats.logs_pending:
+                worker_stats.n_missed += n_missed
+                worker_stats.n_gold += n_gold
+                worker_stats.logs_pending = True
+                worker_stats.save()
+        cursor.last_judgment_id = last_judgment_id
+        cursor.save()
+
+    # Record the gold statistics in XML session files, outside the
+    # transaction so that the cursor is not locked meanwhile.  This includes
+    # workers whose statistics failed to be recorded before.  Should this
+    # fail, the workers stay marked and are dealt with next time.
+    pending = WorkerGoldStats.objects.filter(job_id=job_id, logs_pending=True)
+    gold_stats = {worker_stats.worker_id: worker_stats.gold_score
+                  for worker_stats in pending}
+    if gold_stats:
+        try:
+            n_files, n_anns = update_worker_stats(gold_stats)
+        except Exception as ex:
+            msg = ('{n_judgments} new judgments were collected, but gold '
+                   'ratios of {n_workers} workers could not be recorded in '
+                   'session logs: {ex}.  They will be recorded at the next '
+                   'collection of judgments for the job.').format(
+                       n_judgments=n_judgments, n_workers=len(gold_stats),
+                       ex=ex)
+            return False, msg
+        pending.filter(worker_id__in=gold_stats.keys()).update(
+            logs_pending=False)
+    else:
+        n_files = n_anns = 0
 
     # Return a success message.
-    msg = ('Gold ratios for {n_workers} workers have been updated.  {n_files} '
-           'session logs and {n_anns} individual annotations were updated.'
-           ).format(n_workers=len(gold_stats), n_files=n_files, n_anns=n_anns)
+    msg = ('{n_judgments} new judgments were collected.  Gold ratios for '
+           '{n_workers} workers have been updated.  {n_files} session logs '
+           'and {n_anns} individual annotations were updated.'
+           ).format(n_judgments=n_judgments, n_workers=len(gold_stats),
+                    n_files=n_files, n_anns=n_anns)
     return True, msg
 
 
+def collect_judgments_for_jobs(job_ids):
+    """
+    Collects judgments for several jobs (see `collect_judgments').  The job
+    reports are downloaded concurrently.
+
+    Returns a list of tuples (success?, reason), one for each job.
+
+    """
+    job_ids = list(job_ids)
+    reports = cf_executor.map(_get_job_report, job_ids)
+    return [collect_judgments(job_id, report)
+            for job_id, report in zip(job_ids, reports)]
+
+
 def reconstruct_worker_ids(job_id):
     """
     Tries to fill in the worker_id attribute of annotations in XML logs based
@@ -932,28 +1282,26 @@ def reconstruct_worker_ids(job_id):
 
     """
     # Get the job report.
-    success, msg = _get_job_report(job_id)
+    success, report = _get_job_report(job_id)
     if not success:
-        return False, msg
-
-    # Divide the first row as a CSV header, read the column names.
-    header = msg.obj[0]
-    recs = msg.obj[1:]
-    header_dic = {name: idx for idx, name in enumerate(header)}
-    cid_idx = header_dic['cid']
-    field_idxs = {hook_name: header_dic[HOOKNAMES2CSVNAMES[hook_name]]
-                  for hook_name in settings.LOGGED_JOB_DATA
-                  if hook_name in HOOKNAMES2CSVNAMES}
-    field_idxs['created_at'] = header_dic['_created_at']
-    field_idxs['worker_id'] = header_dic['_worker_id']
-
-    # Transform the information into a suitable form.
-    dgs_anns = dict()  # :: {cid -> [annotation data]}
-    for rec in recs:
-        cid = rec[cid_idx]
-        dg_ann = {hook_name: rec[field_idxs[hook_name]]
-                  for hook_name in field_idxs}
-        dgs_anns.setdefault(cid, list()).append(dg_ann)
+        return False, report
+
+    with report:
+        # Read the column names.
+        cid_idx = report.columns['cid']
+        field_idxs = {hook_name: report.columns[HOOKNAMES2CSVNAMES[hook_name]]
+                      for hook_name in settings.LOGGED_JOB_DATA
+                      if hook_name in HOOKNAMES2CSVNAMES}
+        field_idxs['created_at'] = report.columns['_created_at']
+        field_idxs['worker_id'] = report.columns['_worker_id']
+
+        # Transform the information into a suitable form.
+        dgs_anns = dict()  # :: {cid -> [annotation data]}
+        for rec in report:
+            cid = rec[cid_idx]
+            dg_ann = {hook_name: rec[field_idxs[hook_name]]
+                      for hook_name in field_idxs}
+            dgs_anns.setdefault(cid, list()).append(dg_ann)
 
     record_judgments(dgs_anns)
 
@@ -1039,12 +1387,13 @@ class JsonDialogueUpload(object):
                     gold_dgs = filter(is_gold, self.data[job_id])
                     if gold_dgs:
                         # Wait for CF to update its records.
-                        time.sleep(settings.CF_WAIT_SECS)
-
-                        for dg in gold_dgs:
-                            success, msg = update_gold(dg, job_id)
-                            if not success:
-                                error_msgs.append(msg)
+                        success, msg = _wait_for_units(
+                            job_id, [dg.cid for dg in gold_dgs])
+                        if success:
+                            for success, msg in update_golds(gold_dgs,
+                                                             job_id):
+                                if not success:
+                                    error_msgs.append(msg)
             if not success:
                 error_msgs.append(msg)
 
@@ -0,0 +1,600 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# This code is PEP8-compliant. See http://www.python.org/dev/peps/pep-0008/.
+from __future__ import unicode_literals
+
+from collections import Counter, deque
+from datetime import datetime
+import hashlib
+from itertools import chain, imap, izip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import os.path
+import random
+import shutil
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+
+import session_xml
+from session_xml import FileNotFoundError, XMLSession, UserTurnAbs_nt
+import settings
+if settings.USE_CF:
+    from transcription.crowdflower import JsonDialogueUpload
+from transcription.dg_util import invalidate_turn_layout, update_price
+from transcription.models import (Dialogue, DialogueAnnotation, ImportJob,
+    ImportJobItem, SystemTurn, Transcription, UserTurn)
+from transcription.util import link_or_copy, LINK_STRATEGIES
+
+random.seed()
+
+
+def _hash(s):
+    return hashlib.sha1(s).hexdigest()
+
+
+def _gen_codes():
+    """
+    Generates a random code for a dialogue, to be used in validation of CF
+    workers' input.
+    """
+
+    code = ''.join(random.choice('0123456789')
+                   for _ in xrange(settings.CODE_LENGTH))
+    code_corr = ''.join(random.choice('0123456789')
+                        for _ in xrange(settings.CODE_LENGTH_EXT))
+    code_incorr = code_corr
+    while code_incorr == code_corr:
+        code_incorr = ''.join(random.choice('0123456789')
+                              for _ in xrange(settings.CODE_LENGTH_EXT))
+    return (code, code_corr, code_incorr)
+
+
+def _read_dialogue_turns(dg_data, dirname, with_trss=False, only_order=False):
+    """
+    Reads system and user turns from an XML session file and saves it
+    to the DB.  This function should be called after the dialogue in question
+    has been copied into the target directory (one called after its CID).
+    New objects are inserted in bulk.  This function should be called inside
+    a transaction.
+
+    Arguments:
+        dg_data -- the Django object for the dialogue that should be saved
+        dirname -- path towards the directory where related WAV files should be
+                   looked for
+        with_trss -- should any annotations and transcriptions be read too?
+            (default: False)
+        only_order -- used to fix the order of turns using the `turn_abs_num'
+            datum
+
+    """
+
+    if only_order:
+        sys_turns = SystemTurn.objects.filter(dialogue=dg_data)
+        user_turns = UserTurn.objects.filter(dialogue=dg_data)
+
+        def _get_uturn(uturn_nt):
+            uturn = user_turns.get(turn_number=uturn_nt.turn_number)
+            uturn.turn_abs_number = uturn_nt.turn_abs_number
+            return uturn
+
+        def _get_systurn(systurn_nt):
+            systurn = sys_turns.get(turn_number=systurn_nt.turn_number)
+            systurn.turn_abs_number = systurn_nt.turn_abs_number
+            return systurn
+    else:
+
+        def _get_uturn(uturn_nt):
+            return UserTurn(dialogue=dg_data,
+                            turn_number=turnnum,
+                            turn_abs_number=uturn_nt.turn_abs_number,
+                            wav_fname=wav_path,
+                            asr_hyp=uturn_nt.asr_hyp,
+                            slu_hyp=uturn_nt.slu_hyp)
+
+        def _get_systurn(systurn_nt):
+            return SystemTurn(dialogue=dg_data,
+                              turn_number=systurn_nt.turn_number,
+                              turn_abs_number=systurn_nt.turn_abs_number,
+                              text=systurn_nt.text)
+
+    with XMLSession(dg_data.cid) as session:
+
+        # Save all the turns as database objects.
+        uturns = list()
+        systurns = list()
+        for turn_nt in session.iter_turns():
+            # Take special care to not overwrite user turns with other user
+            # turns with a duplicate turn number (known fault of some XML
+            # logs).
+            if isinstance(turn_nt, UserTurnAbs_nt):
+                if turn_nt.wav_fname is not None:
+                    turnnum = turn_nt.turn_number
+                    # Do not override turns saved earlier.
+                    if (turnnum < len(uturns) and
+                            uturns[turnnum] is not None):
+                        continue
+
+                    # Create the user turn object.
+                    wav_path = os.path.join(dirname, turn_nt.wav_fname)
+                    uturn = _get_uturn(turn_nt)
+
+                    # Prepare the `uturns' list for storing the new user
+                    # turn.
+                    while turnnum > len(uturns):
+                        uturns.append(None)
+
+                    # Remember the user turn object.
+                    uturns.append(uturn)
+                    assert (uturns[turnnum] == uturn)
+            else:
+                systurns.append(_get_systurn(turn_nt))
+        uturns = filter(None, uturns)
+        if only_order:
+            for turn in chain(uturns, systurns):
+                turn.save()
+        else:
+            UserTurn.objects.bulk_create(uturns)
+            SystemTurn.objects.bulk_create(systurns)
+
+        # The turns have changed, so their layout has to be computed anew.
+        invalidate_turn_layout(dg_data)
+
+        if only_order:
+            return
+
+        # If transcriptions should be read and saved as well,
+        if with_trss:
+            dummy_user = None
+
+            # Find the IDs the user turns were saved with (bulk_create does
+            # not tell).
+            uturn_ids = dict(UserTurn.objects.filter(dialogue=dg_data)
+                             .values_list('turn_number', 'pk'))
+            # Look up all the annotators at once.
+            ann_els = list(session.iter_annotations())
+            usernames = set(ann_el.get('user') for ann_el in ann_els)
+            usernames.discard(None)
+            users = {user.username: user for user in
+                     User.objects.filter(username__in=usernames)}
+
+            # Iterate over all dialogue annotations.
+            for ann_el in ann_els:
+                # Retrieve all properties of the dialogue annotation
+                # object.
+                notes = ('' if ann_el.text is None
+                         else ann_el.text.strip())
+                program_version = ann_el.get('program_version')
+                ann_user = users.get(ann_el.get('user'), dummy_user)
+
+                ann_props = {'dialogue': dg_data,
+                             'notes': notes,
+                             'user': ann_user,
+                             'program_version': program_version}
+
+                if 'accent' in settings.EXTRA_QUESTIONS:
+                    accent_str = ann_el.get('accent')
+                    accent = ("" if accent_str == 'native' else accent_str)
+                    ann_props['accent'] = accent
+                if 'offensive' in settings.EXTRA_QUESTIONS:
+                    offensive = (ann_el.get("offensive") == "True")
+                    ann_props['offensive'] = offensive
+                if 'quality' in settings.EXTRA_QUESTIONS:
+                    quality = (DialogueAnnotation.QUALITY_CLEAR
+                               if ann_el.get('quality') == 'clear'
+                               else DialogueAnnotation.QUALITY_NOISY)
+                    ann_props['quality'] = quality
+
+                date_saved = session.parse_datetime(ann_el.get('date_saved'))
+
+                # Check whether this object has been imported already.
+                if not DialogueAnnotation.objects.filter(
+                        date_saved=date_saved, **ann_props):
+                    # Save the dialogue annotation.
+                    dg_ann = DialogueAnnotation(**ann_props)
+                    dg_ann.save()
+
+                    # Find all transcriptions that belong to this dialogue
+                    # annotation and save them as database objects.
+                    trss = list()
+                    for turnnum, trs_el in session.iter_transcriptions(
+                            ann_el):
+                        i_gold = (trs_el.get('is_gold') != '0')
+                        b_gold = (trs_el.get('breaks_gold') != '0')
+                        sb_gold = (trs_el.get('some_breaks_gold') != '0')
+                        trss.append(Transcription(
+                            text=trs_el.text,
+                            turn_id=uturn_ids[turnnum],
+                            dialogue_annotation=dg_ann,
+                            is_gold=i_gold,
+                            breaks_gold=b_gold,
+                            some_breaks_gold=sb_gold))
+                    Transcription.objects.bulk_create(trss)
+
+
+def _check_session(src_fname):
+    """
+    Finds the session XML log of a dialogue to be imported and checks that
+    there are enough user turns in it.  This is run in worker processes of
+    `import_dialogues'.
+
+    Arguments:
+        src_fname -- path towards the dialogue directory
+
+    Returns a tuple (sess_fname, rec_fnames) where `sess_fname' is the path
+    towards the session log, or None if there is none, and `rec_fnames' is
+    a list of names of audio files referred to from the session, or None if
+    there are too few user turns in it.
+
+    """
+    try:
+        sess_fname = XMLSession.find_session_fname(src_fname)
+    except FileNotFoundError:
+        return None, None
+    rec_fnames = list()
+    with XMLSession(fname=sess_fname, mode='r') as session:
+        uturn_num = n_empty_turns = 0
+        for uturn_num, uturn_nt in enumerate(session.iter_uturns(), start=1):
+            if not uturn_nt.wav_fname:
+                n_empty_turns += 1
+            else:
+                rec_fnames.append(uturn_nt.wav_fname)
+    if uturn_num - n_empty_turns < settings.MIN_TURNS:
+        return sess_fname, None
+    return sess_fname, rec_fnames
+
+
+def _copy_dialogue(src_fname, sess_fname, rec_fnames, tgt_fname,
+                   link_audio=False):
+    """
+    Copies the session log and the audio of a dialogue into its new
+    directory, which has been made by `_make_dialogue_dir'.  This is run in
+    worker threads of `import_dialogues'.
+
+    Keyword arguments:
+        link_audio -- whether to link the audio files rather than copy them
+            where possible (see `util.link_or_copy').  The session log is
+            always copied as it gets modified.
+
+    Returns a Counter of strategies used to bring in the audio files, or
+    None if some of the files could not be copied.
+
+    """
+    strategies = Counter()
+    try:
+        # Copy the session XML log.
+        shutil.copy2(sess_fname, tgt_fname)
+        # Copy all the audio needed.
+        for rec_fname in rec_fnames:
+            rec_path = os.path.join(src_fname, rec_fname)
+            if link_audio:
+                strategies[link_or_copy(rec_path, tgt_fname)] += 1
+            else:
+                shutil.copy2(rec_path, tgt_fname)
+                strategies['copy'] += 1
+    except:
+        return None
+    return strategies
+
+
+def _save_item(job, line_number, src_fname, outcome, cid):
+    """Saves the import job item for a line, or updates its outcome."""
+    if not ImportJobItem.objects.filter(
+            job=job, line_number=line_number).update(outcome=outcome,
+                                                     cid=cid):
+        ImportJobItem(job=job, line_number=line_number, src_fname=src_fname,
+                      cid=cid, outcome=outcome).save()
+
+
+def _make_dialogue_dir(job, line_number, src_fname, cid, tgt_fname):
+    """
+    Makes the directory for the files of a dialogue and records that this
+    job has made it, so that it can be removed if the job gets interrupted
+    before the dialogue is saved.
+
+    Returns whether the directory has been made (it has not if it existed
+    already).
+
+    """
+    try:
+        os.mkdir(tgt_fname)
+    except OSError:
+        return False
+    _save_item(job, line_number, src_fname, 'copying', cid)
+    return True
+
+
+def _checkpoint(job, line_number, src_fname, outcome, cid='',
+                strategies=None):
+    """
+    Records the outcome of importing one listed dialogue directory.
+
+    Keyword arguments:
+        cid -- CID of the dialogue, if it has been assigned one
+        strategies -- a Counter of strategies used to bring in the audio
+            files of the dialogue (see `_copy_dialogue')
+
+    """
+    _save_item(job, line_number, src_fname, outcome, cid)
+    if strategies:
+        counts = {'n_' + strategy: F('n_' + strategy) + n_files
+                  for strategy, n_files in strategies.iteritems()}
+        ImportJob.objects.filter(pk=job.pk).update(**counts)
+
+
+def _save_dialogue(job, line_number, src_fname, cid, dirname, tgt_fname,
+                   strategies):
+    """
+    Creates an object for a newly copied dialogue, reads its turns, and
+    records the outcome, all in one transaction.  The saves are guarded by
+    savepoints so that the outcome can still be recorded if they fail.
+    """
+    # Generate codes and other defining attributes of the dialogue.
+    dg_codes = _gen_codes()
+    dg_data = Dialogue(cid=cid,
+                       code=dg_codes[0],
+                       code_corr=dg_codes[1],
+                       code_incorr=dg_codes[2],
+                       dirname=dirname,
+                       list_filename=job.list_filename)
+    with transaction.commit_on_success():
+        sid = transaction.savepoint()
+        try:
+            dg_data.save()
+        except:
+            transaction.savepoint_rollback(sid)
+            outcome = 'save_failed'
+        else:
+            transaction.savepoint_commit(sid)
+            # Read the dialogue turns.
+            _read_dialogue_turns(dg_data, tgt_fname, job.with_trss,
+                                 only_order=False)
+            # Compute the dialogue price.
+            update_price(dg_data)
+            # Update the dialogue in the DB.
+            sid = transaction.savepoint()
+            try:
+                dg_data.save()
+            except:
+                transaction.savepoint_rollback(sid)
+                outcome = 'save_price_failed'
+            else:
+                transaction.savepoint_commit(sid)
+                outcome = 'imported'
+        _checkpoint(job, line_number, src_fname, outcome, cid, strategies)
+
+
+def _store_dialogue(job, line_number, src_fname, dirname, cid, dg_exists,
+                    tgt_fname, copied):
+    """
+    Saves a dialogue whose files have been copied (or waits for the copying
+    to finish first), and records the outcome.  This is the DB stage of
+    `run_import_job'.
+
+    Arguments:
+        copied -- the AsyncResult of `_copy_dialogue' for the dialogue, or
+            None if its files have not been copied
+
+    """
+    strategies = None if copied is None else copied.get()
+    if strategies is not None:
+        # Index any annotations the session log comes with.
+        session_xml.index_annotations(cid)
+    elif not job.ignore_exdirs:
+        _checkpoint(job, line_number, src_fname, 'copy_failed', cid)
+        return
+
+    # Create an object for the dialogue and save it in the DB, unless it has
+    # been there already.
+    if dg_exists:
+        # XXX If only updating the absolute turn numbers,
+        if job.only_order:
+            # Do update the order.
+            dg_data = Dialogue.objects.get(cid=cid)
+            with transaction.commit_on_success():
+                _read_dialogue_turns(dg_data, tgt_fname, job.with_trss,
+                                     only_order=True)
+                _checkpoint(job, line_number, src_fname, 'dg_updated', cid,
+                            strategies)
+        else:
+            _checkpoint(job, line_number, src_fname, 'dg_existed', cid,
+                        strategies)
+        return
+    _save_dialogue(job, line_number, src_fname, cid, dirname, tgt_fname,
+                   strategies)
+
+
+def run_import_job(job, use_processes=False):
+    """
+    Imports dialogues as requested by an import job, or resumes the job if it
+    has been interrupted.
+
+    The import is a pipeline of three stages: session logs are parsed and
+    checked in a pool of processes, files are copied in a pool of threads
+    (the copying is I/O bound), and the dialogues are saved in the DB by the
+    calling thread alone, each as soon as its files have been copied.  The
+    outcome is recorded for each dialogue directory as it is dealt with, and
+    directories with a recorded outcome are skipped when the job is resumed.
+
+    Arguments:
+        job -- the ImportJob to run
+
+    Keyword arguments:
+        use_processes -- whether session logs may be checked in a pool of
+            `job.parse_procs' processes rather than serially.  Only pass True
+            from a process of its own, such as the `run_import_jobs'
+            management command, as the pool is forked from the calling
+            process.
+
+    """
+    # Find out what remains to be done.
+    with open(job.list_filename, 'r') as dirlist_file:
+        src_fnames = [line.rstrip().rstrip(os.sep) for line in dirlist_file]
+    resumed = job.date_started is not None
+    items = ImportJobItem.objects.filter(job=job)
+    done = set(items.exclude(outcome='copying')
+               .values_list('line_number', flat=True))
+    # Dialogue directories made by an interrupted run of this job.
+    made_cids = set(items.filter(outcome='copying')
+                    .values_list('cid', flat=True))
+    todo = [(line_number, src_fname)
+            for line_number, src_fname in enumerate(src_fnames)
+            if line_number not in done]
+    job_attrs = {'n_dialogues': len(src_fnames)}
+    if not resumed:
+        job_attrs['date_started'] = datetime.now()
+    ImportJob.objects.filter(pk=job.pk).update(**job_attrs)
+
+    # Find out which CIDs are used already, and for which dialogue
+    # directories.
+    cid2dirname = dict(Dialogue.objects.values_list('cid', 'dirname'))
+    new_cids = set()
+
+    # Do the import.
+    parse_pool = (multiprocessing.Pool(job.parse_procs)
+                  if use_processes and job.parse_procs > 1 else None)
+    copy_pool = ThreadPool(job.copy_threads)
+    try:
+        # Check the session logs.
+        todo_fnames = [src_fname for _, src_fname in todo]
+        if parse_pool is None:
+            checked = imap(_check_session, todo_fnames)
+        else:
+            checked = parse_pool.imap(_check_session, todo_fnames,
+                                      chunksize=8)
+
+        # Start copying files of each dialogue as soon as its session log
+        # has been checked, and save each dialogue as soon as its files have
+        # been copied.  The dialogues are saved in the order they were
+        # listed; if too many of them are waiting, the oldest copy is waited
+        # for.
+        pending = deque()
+        max_pending = 4 * job.copy_threads
+        for (line_number, src_fname), (sess_fname, rec_fnames) in izip(
+                todo, checked):
+            if sess_fname is None:
+                _checkpoint(job, line_number, src_fname, 'session_missing')
+                continue
+            if rec_fnames is None:
+                _checkpoint(job, line_number, src_fname, 'session_empty')
+                continue
+            dirname = os.path.basename(src_fname)
+
+            # Generate CID.
+            cid = _hash(dirname)
+            # Check that this CID does not collide with a hash for another
+            # dirname.  This is a crude implementation of hashing with
+            # replacement.
+            salt = -1
+            while cid2dirname.get(cid, dirname) != dirname:
+                salt += 1
+                cid = _hash(dirname + str(salt))
+            dg_exists = cid in cid2dirname
+            cid2dirname[cid] = dirname
+
+            # Copy the dialogue files, unless the same dialogue is being
+            # copied already.
+            tgt_fname = os.path.join(settings.CONVERSATION_DIR, cid)
+            if cid in new_cids:
+                copied = None
+            else:
+                new_cids.add(cid)
+                # Files of a dialogue not saved in the DB are a leftover from
+                # an interrupted run of this job if the job has made their
+                # directory.
+                if (resumed and not dg_exists and cid in made_cids
+                        and os.path.isdir(tgt_fname)):
+                    shutil.rmtree(tgt_fname)
+                if _make_dialogue_dir(job, line_number, src_fname, cid,
+                                      tgt_fname):
+                    copied = copy_pool.apply_async(
+                        _copy_dialogue,
+                        (src_fname, sess_fname, rec_fnames, tgt_fname,
+                         job.link_audio))
+                else:
+                    copied = None
+            pending.append((line_number, src_fname, dirname, cid, dg_exists,
+                            tgt_fname, copied))
+            while pending and (len(pending) > max_pending or
+                               pending[0][-1] is None or
+                               pending[0][-1].ready()):
+                _store_dialogue(job, *pending.popleft())
+
+        # All the session logs have been checked by now.
+        if parse_pool is not None:
+            parse_pool.close()
+        copy_pool.close()
+
+        # Save the rest of the dialogues.
+        while pending:
+            _store_dialogue(job, *pending.popleft())
+    finally:
+        # Do not leave any workers behind, even if something went wrong.
+        if parse_pool is not None:
+            parse_pool.terminate()
+            parse_pool.join()
+        copy_pool.terminate()
+        copy_pool.join()
+
+    # Describe the imported dialogues in a CSV file for CrowdFlower (kept for
+    # extra safety), and upload them to CrowdFlower if asked to.
+    imported = ImportJobItem.objects.filter(job=job, outcome='imported')
+    cid2dg = {dg.cid: dg for dg in
+              Dialogue.objects.filter(cid__in=imported.values('cid'))}
+    imported_dgs = [cid2dg[imported_cid] for imported_cid in
+                    imported.order_by('line_number')
+                    .values_list('cid', flat=True)
+                    if imported_cid in cid2dg]
+    csv_dirname = os.path.dirname(job.csv_fname)
+    if not os.path.isdir(csv_dirname):
+        os.makedirs(csv_dirname)
+    with open(job.csv_fname, 'w') as csv_file:
+        csv_file.write('cid,code,code_gold\n')
+        for dg_data in imported_dgs:
+            csv_file.write('{cid},{code},{gold}\n'.format(
+                cid=dg_data.cid, code=dg_data.code,
+                gold=dg_data.get_code_gold()))
+    cf_error = ''
+    if job.upload and imported_dgs:
+        cf_ret, cf_msg = JsonDialogueUpload(imported_dgs).upload()
+        if cf_ret is False:
+            cf_error = cf_msg
+
+    ImportJob.objects.filter(pk=job.pk).update(
+        status=ImportJob.STATUS_DONE, cf_error=cf_error,
+        date_finished=datetime.now())
+
+
+def import_report(job):
+    """
+    Summarises the outcomes of an import job for the `imported.html'
+    template.
+    """
+    context = {outcome: list()
+               for outcome, _ in ImportJobItem.OUTCOME_CHOICES
+               if outcome != 'copying'}
+    items = (ImportJobItem.objects.filter(job=job)
+             .exclude(outcome='copying').order_by('line_number')
+             .values_list('src_fname', 'cid', 'outcome'))
+    for src_fname, cid, outcome in items:
+        dirname = os.path.basename(src_fname)
+        if outcome in ('session_missing', 'session_empty', 'copy_failed'):
+            context[outcome].append(src_fname)
+        elif outcome in ('save_failed', 'save_price_failed'):
+            context[outcome].append((dirname, cid))
+        else:
+            context[outcome].append(dirname)
+    count = len(context.pop('imported'))
+    context['n_failed'] = sum(map(len, context.itervalues()))
+    context['count'] = count
+    context['MIN_TURNS'] = settings.MIN_TURNS
+    context['csv_fname'] = job.csv_fname
+    context['cf_upload'] = job.upload
+    context['cf_error'] = job.cf_error or None
+    context['link_counts'] = [
+        (strategy, getattr(job, 'n_' + strategy))
+        for strategy in LINK_STRATEGIES
+        if getattr(job, 'n_' + strategy)]
+    return context
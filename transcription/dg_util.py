@@ -1,10 +1,16 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+from datetime import datetime
 import os
 import os.path
 
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
 import settings
-from transcription.models import Transcription, UserTurn
+from transcription.models import (Dialogue, DialogueAnnotation,
+    SemanticAnnotation, Transcription, UserTurn)
 
 
 def is_gold(dg):
@@ -27,3 +33,77 @@ def update_price(dg):
     price = (settings.PRICE_CONST + settings.PRICE_PER_MIN * minutes
              + settings.PRICE_PER_TURN * len(uturns))
     dg.transcription_price = price
+
+
+def turn_layout_key(dg):
+    """Returns the cache key of the turn layout of a dialogue."""
+    return 'turn_layout:{pk}'.format(pk=dg.pk)
+
+
+def invalidate_turn_layout(dg):
+    """Drops the cached turn layout of a dialogue (e.g. when turns change)."""
+    cache.delete(turn_layout_key(dg))
+
+
+def delete_old_anns(batch_size=500):
+    """
+    Deletes unfinished dialogue annotations started longer than
+    SESSION_EXPIRED ago, together with their transcriptions.  The annotations
+    are deleted in batches, each in its own transaction, so that the database
+    does not stay locked for long.
+
+    Keyword arguments:
+        batch_size -- how many annotations to delete at once (default: 500)
+
+    Returns a tuple (number of annotations deleted, number of transcriptions
+    and semantic annotations deleted).
+
+    """
+    sessions_earliest_start = datetime.now() - settings.SESSION_EXPIRED
+    old_anns = DialogueAnnotation.objects.filter(
+        finished=False,
+        date_saved__lte=sessions_earliest_start)
+    n_anns = n_trss = 0
+    while True:
+        batch = list(old_anns.values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            break
+        with transaction.commit_on_success():
+            # Check the annotations have not been finished in the meantime.
+            batch_anns = old_anns.filter(pk__in=batch)
+            n_anns += batch_anns.count()
+            n_trss += (
+                Transcription.objects.filter(
+                    dialogue_annotation__in=batch_anns).count() +
+                SemanticAnnotation.objects.filter(
+                    dialogue_annotation__in=batch_anns).count())
+            batch_anns.delete()
+    return n_anns, n_trss
+
+
+def recount_anns():
+    """
+    Recomputes the number of annotations kept with each dialogue
+    (`Dialogue.n_annotations') from the dialogue annotations in the
+    database.  The counts are kept up to date by signal handlers, which do
+    not see annotations created or deleted behind the ORM's back (e.g. in
+    bulk or by SQL).  Each wrong count is fixed in its own transaction, with
+    the dialogue locked so that annotations saved meanwhile are not missed.
+
+    Returns the number of dialogues whose count has been fixed.
+
+    """
+    counts = (Dialogue.objects.annotate(n_anns=Count('dialogueannotation'))
+              .values_list('cid', 'n_annotations', 'n_anns'))
+    wrong_cids = [cid for cid, n_annotations, n_anns in counts
+                  if n_annotations != n_anns]
+    n_fixed = 0
+    for cid in wrong_cids:
+        with transaction.commit_on_success():
+            # Count the annotations again now that the dialogue is locked.
+            list(Dialogue.objects.select_for_update().filter(cid=cid)
+                 .values_list('cid', flat=True))
+            n_anns = DialogueAnnotation.objects.filter(dialogue=cid).count()
+            n_fixed += Dialogue.objects.filter(cid=cid).exclude(
+                n_annotations=n_anns).update(n_annotations=n_anns)
+    return n_fixed
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# This code is PEP8-compliant. See http://www.python.org/dev/peps/pep-0008/.
+from collections import defaultdict
+import httplib
+import shutil
+import socket
+from threading import BoundedSemaphore, Lock
+import time
+import urlparse
+
+
+class ConnectionPool(object):
+    """
+    Keeps connections to HTTP(S) servers open between requests, so that
+    subsequent requests to the same host need not set up a new TCP connection
+    and TLS session each.
+
+    The pool is thread-safe.  It has at most `max_per_host' connections to
+    each host in use at a time (more requests wait for one of them to be
+    released), and closes connections that have been idle for longer than
+    `max_idle_secs'.
+
+    """
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    # Methods of requests that can be sent again safely if it is not known
+    # whether the server has received them.
+    IDEMPOTENT_VERBS = ('GET', 'HEAD', 'OPTIONS')
+    COPY_BUFSIZE = 1 << 16
+
+    def __init__(self, max_per_host=8, max_idle_secs=30., timeout=60.,
+                 max_redirects=5):
+        """
+        Keyword arguments:
+            max_per_host -- maximum number of connections to one host in use
+                at a time (default: 8)
+            max_idle_secs -- how long an idle connection is kept open, in
+                seconds (default: 30)
+            timeout -- timeout for socket operations, in seconds (default: 60)
+            max_redirects -- maximum number of redirects followed for one
+                request (default: 5)
+
+        """
+        self.max_per_host = max_per_host
+        self.max_idle_secs = max_idle_secs
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._lock = Lock()
+        # :: {(scheme, host, port) -> [(connection, time of release)]}
+        self._idle = defaultdict(list)
+        # :: {(scheme, host, port) -> BoundedSemaphore}
+        self._slots = dict()
+
+    def _get_slots(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = BoundedSemaphore(self.max_per_host)
+            return self._slots[key]
+
+    def _take(self, key):
+        """
+        Takes an idle connection to a host, or creates a new one.  Returns
+        a tuple (connection, whether the connection has been used before).
+        """
+        expired = list()
+        conn = None
+        with self._lock:
+            idle = self._idle[key]
+            deadline = time.time() - self.max_idle_secs
+            while idle:
+                idle_conn, released = idle.pop()
+                if released >= deadline:
+                    conn = idle_conn
+                    break
+                expired.append(idle_conn)
+            # Connections at the bottom of the stack have been idle for the
+            # longest time.
+            while idle and idle[0][1] < deadline:
+                expired.append(idle.pop(0)[0])
+        for idle_conn in expired:
+            idle_conn.close()
+        if conn is not None:
+            return conn, True
+        scheme, host, port = key
+        conn_cls = (httplib.HTTPSConnection if scheme == 'https'
+                    else httplib.HTTPConnection)
+        return conn_cls(host, port, timeout=self.timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            self._idle[key].append((conn, time.time()))
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle = self._idle
+            self._idle = defaultdict(list)
+        for conns in idle.itervalues():
+            for conn, _ in conns:
+                conn.close()
+
+    def _request_once(self, verb, url, body, headers, out_file):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if out_file is not None:
+            out_start = out_file.tell()
+        with self._get_slots(key):
+            while True:
+                conn, reused = self._take(key)
+                sent = False
+                try:
+                    conn.request(verb, path, body, headers)
+                    sent = True
+                    response = conn.getresponse()
+                    if out_file is not None and 200 <= response.status < 300:
+                        shutil.copyfileobj(response, out_file,
+                                           self.COPY_BUFSIZE)
+                        res_body = None
+                    else:
+                        res_body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    # The server may have closed a connection that has been
+                    # kept open.  Retry with another one then, unless the
+                    # server may have acted on the request already.
+                    if reused and (not sent or verb in self.IDEMPOTENT_VERBS):
+                        if out_file is not None:
+                            out_file.seek(out_start)
+                            out_file.truncate()
+                        continue
+                    raise
+                except:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(key, conn)
+                return (response.status, response.reason,
+                        dict(response.getheaders()), res_body)
+
+    def request(self, verb, url, body=None, headers=None, out_file=None):
+        """
+        Sends an HTTP request and reads the response, following redirects.
+
+        Arguments:
+            verb -- the HTTP method
+            url -- the absolute URL to request
+
+        Keyword arguments:
+            body -- the request body (a string), if any
+            headers -- a mapping of request headers
+            out_file -- a file to write the body of a successful (2xx)
+                response to, in chunks, instead of reading it into memory
+
+        Returns a tuple (status, reason, headers, body) describing the
+        response, with header names lowercased.  The body is None if it has
+        been written to `out_file'.  Raises httplib.HTTPException or
+        socket.error if no response is received.  A request sent through
+        a connection kept open is repeated on a new connection if the old one
+        turns out to have been closed, but only if the request has not been
+        sent yet or if its method is idempotent.
+
+        """
+        headers = dict(headers or ())
+        for _ in xrange(self.max_redirects + 1):
+            status, reason, res_headers, res_body = self._request_once(
+                verb, url, body, headers, out_file)
+            if (status not in self.REDIRECT_STATUSES
+                    or 'location' not in res_headers):
+                break
+            url = urlparse.urljoin(url, res_headers['location'])
+            # Like browsers do, follow other than temporary and permanent
+            # redirects with a GET.
+            if status in (301, 302, 303) and verb != 'HEAD':
+                verb = 'GET'
+                body = None
+                headers.pop('Content-Type', None)
+        return status, reason, res_headers, res_body
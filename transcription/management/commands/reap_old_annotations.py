@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from transcription.dg_util import delete_old_anns
+
+
+class Command(BaseCommand):
+    help = ('Deletes unfinished dialogue annotations started longer than '
+            'SESSION_EXPIRED ago, together with their transcriptions.  Run '
+            'this periodically, e.g. from cron.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=500,
+                    help='How many annotations to delete in one transaction '
+                         '(default: 500).'),
+    )
+
+    def handle(self, *args, **options):
+        n_anns, n_trss = delete_old_anns(batch_size=options['batch_size'])
+        self.stdout.write('Deleted {n_anns} expired annotations and {n_trss} '
+                          'of their transcriptions.\n'.format(n_anns=n_anns,
+                                                              n_trss=n_trss))
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import settings
+from transcription.session_xml import parallel_sweeps, rebuild_ann_index
+
+
+class Command(BaseCommand):
+    help = ('Builds the index of dialogue directories by worker and '
+            'annotation IDs (ANN_INDEX_DIR) anew from all session logs.  Run '
+            'this once after configuring the index, and whenever session logs '
+            'have been changed other than through this site.  Until the '
+            'index is built, all session logs are scanned instead.')
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    type='int',
+                    dest='processes',
+                    default=None,
+                    help='How many processes to read session logs in '
+                         '(default: as many as there are CPUs).'),
+    )
+
+    def handle(self, *args, **options):
+        if not settings.ANN_INDEX_DIR:
+            raise CommandError('ANN_INDEX_DIR is not configured.')
+        with parallel_sweeps(options['processes']):
+            n_files, n_anns = rebuild_ann_index()
+        self.stdout.write('Indexed {n_anns} annotations in {n_files} session '
+                          'logs.\n'.format(n_anns=n_anns, n_files=n_files))
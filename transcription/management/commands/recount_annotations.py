@@ -0,0 +1,20 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from transcription.dg_util import recount_anns
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the number of annotations kept with each dialogue '
+            'from the dialogue annotations in the database.  Run this after '
+            'adding or deleting annotations other than through this site, '
+            'e.g. by SQL.')
+
+    def handle(self, *args, **options):
+        n_fixed = recount_anns()
+        self.stdout.write('Fixed annotation counts of {n} dialogues.\n'
+                          .format(n=n_fixed))
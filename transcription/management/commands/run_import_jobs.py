@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+from optparse import make_option
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+
+from transcription.dg_import import run_import_job
+from transcription.models import ImportJob
+
+
+class Command(BaseCommand):
+    args = '[JOB_ID ...]'
+    help = ('Runs dialogue import jobs queued from the import page.  If job '
+            'IDs are given, runs just those jobs, resuming them if they have '
+            'been interrupted or have failed.  Do not resume a job that is '
+            'still being run by another process.')
+    option_list = BaseCommand.option_list + (
+        make_option('--poll',
+                    type='float',
+                    dest='poll',
+                    default=None,
+                    help='Keep running, and look for new jobs every POLL '
+                         'seconds (default: exit once the queue is empty).'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            for job_id in args:
+                self._run(int(job_id), (ImportJob.STATUS_QUEUED,
+                                        ImportJob.STATUS_RUNNING,
+                                        ImportJob.STATUS_FAILED))
+            return
+
+        while True:
+            queued = (ImportJob.objects.filter(status=ImportJob.STATUS_QUEUED)
+                      .order_by('pk').values_list('pk', flat=True))
+            for job_id in queued:
+                self._run(job_id, (ImportJob.STATUS_QUEUED, ))
+            if options['poll'] is None:
+                break
+            time.sleep(options['poll'])
+
+    def _run(self, job_id, statuses):
+        # Claim the job, unless another worker has done so.
+        if not ImportJob.objects.filter(pk=job_id, status__in=statuses)\
+                .update(status=ImportJob.STATUS_RUNNING, error=''):
+            self.stderr.write('Import job {job} cannot be run.\n'
+                              .format(job=job_id))
+            return
+        job = ImportJob.objects.get(pk=job_id)
+        try:
+            run_import_job(job, use_processes=True)
+        except Exception:
+            ImportJob.objects.filter(pk=job_id).update(
+                status=ImportJob.STATUS_FAILED,
+                error=traceback.format_exc(),
+                date_finished=datetime.now())
+            self.stderr.write('Import job {job} failed:\n{tb}'.format(
+                job=job_id, tb=traceback.format_exc()))
+        else:
+            n_imported = job.importjobitem_set.filter(
+                outcome='imported').count()
+            self.stdout.write('Import job {job} done: {n} dialogues '
+                              'imported.\n'.format(job=job_id, n=n_imported))
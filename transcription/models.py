@@ -4,7 +4,8 @@
 from __future__ import unicode_literals
 
 from django.db import models
-from django.db.models.signals import post_save, pre_save
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.contrib.auth.models import User
 
 from db_fields import ROCharField, WavField, SizedTextField
@@ -32,6 +33,10 @@ class Dialogue(models.Model):
     """ price of this dialogue's transcriptions in USD """
     list_filename = models.FilePathField(path=LISTS_DIR, recursive=True,
                                          null=True, blank=True)
+    n_annotations = models.PositiveIntegerField(default=0, db_index=True,
+                                                editable=False)
+    """ number of dialogue annotations of this dialogue (kept up to date by
+    DialogueAnnotation signal handlers) """
 
     def __unicode__(self):
         return '({c}: {d})'.format(c=self.cid, d=self.dirname)
@@ -101,6 +106,27 @@ class DialogueAnnotation(models.Model):
 
         return self.uni_tpt.format(**tpt_kwargs)
 
+    @staticmethod
+    def post_save(sender, **kwargs):
+        """Counts the new annotation with its dialogue."""
+        dg_ann = kwargs['instance']
+        # Annotations leased in views have been counted already.
+        if kwargs['created'] and not getattr(dg_ann, 'counted', False):
+            Dialogue.objects.filter(cid=dg_ann.dialogue_id).update(
+                n_annotations=F('n_annotations') + 1)
+
+    @staticmethod
+    def post_delete(sender, **kwargs):
+        """Uncounts the deleted annotation with its dialogue."""
+        dg_ann = kwargs['instance']
+        Dialogue.objects.filter(cid=dg_ann.dialogue_id,
+                                n_annotations__gt=0).update(
+            n_annotations=F('n_annotations') - 1)
+
+
+post_save.connect(DialogueAnnotation.post_save, sender=DialogueAnnotation)
+post_delete.connect(DialogueAnnotation.post_delete, sender=DialogueAnnotation)
+
 
 class DialogueTurn(models.Model):
     """An abstract class for one turn in a dialogue."""
@@ -235,6 +261,7 @@ class AbstractTranscription(models.Model):
             attribs['some_breaks_gold'] = '1' if trs.some_breaks_gold else '0'
             attribs['date_updated'] = session.format_datetime(trs.date_updated)
             trs_xml.text = trs.text
+            session.mark_dirty()
 
 
 pre_save.connect(AbstractTranscription.pre_save, sender=AbstractTranscription)
@@ -275,6 +302,98 @@ class AbstractPriceClass(models.Model):
         return '({price}c)'.format(price=self.cents)
 
 
+class ImportJob(models.Model):
+    """
+    A request to import dialogues from a file list.  Import jobs are run in
+    the background by the `run_import_jobs' management command.
+    """
+    STATUS_QUEUED = 'q'
+    STATUS_RUNNING = 'r'
+    STATUS_DONE = 'd'
+    STATUS_FAILED = 'f'
+    STATUS_CHOICES = ((STATUS_QUEUED, 'queued'),
+                      (STATUS_RUNNING, 'running'),
+                      (STATUS_DONE, 'done'),
+                      (STATUS_FAILED, 'failed'))
+
+    list_filename = models.CharField(max_length=255)
+    """ path towards the file listing dialogue directories to import """
+    csv_fname = models.CharField(max_length=255)
+    """ path towards the CSV file describing the imported dialogues """
+    with_trss = models.BooleanField(default=False)
+    """ whether to import also transcriptions found in the session logs """
+    only_order = models.BooleanField(default=False)
+    """ whether to only update absolute turn numbers of existing dialogues """
+    ignore_exdirs = models.BooleanField(default=False)
+    """ whether to ignore copy errors due to existing directories """
+    upload = models.BooleanField(default=False)
+    """ whether to upload the imported dialogues to Crowdflower """
+    link_audio = models.BooleanField(default=False)
+    """ whether to link audio files instead of copying them where possible """
+    parse_procs = models.PositiveSmallIntegerField(default=1)
+    """ number of processes for checking session logs """
+    copy_threads = models.PositiveSmallIntegerField(default=1)
+    """ number of threads for copying files """
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES,
+                              default=STATUS_QUEUED, db_index=True)
+    n_dialogues = models.PositiveIntegerField(null=True, blank=True)
+    """ number of dialogue directories listed (known once the job starts) """
+    n_hardlink = models.PositiveIntegerField(default=0)
+    n_reflink = models.PositiveIntegerField(default=0)
+    n_symlink = models.PositiveIntegerField(default=0)
+    n_copy = models.PositiveIntegerField(default=0)
+    """ numbers of audio files brought in by each of util.LINK_STRATEGIES """
+    error = models.TextField(blank=True, default='')
+    """ why the job failed """
+    cf_error = models.TextField(blank=True, default='')
+    """ why uploading the dialogues to Crowdflower failed """
+    date_created = models.DateTimeField(auto_now_add=True, editable=False)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '(import {pk}: {fname}; {status})'.format(
+            pk=self.pk, fname=self.list_filename,
+            status=self.get_status_display())
+
+
+class ImportJobItem(models.Model):
+    """
+    The outcome of importing one listed dialogue directory.  Items are saved
+    as soon as their dialogue has been dealt with, and serve as checkpoints
+    of their import job.  An item is saved with the outcome `copying' before
+    the files of its dialogue are copied into a directory the job has just
+    created, so that a resumed job can tell its own leftovers.
+    """
+    # The outcomes are named after lists in the import report, except for
+    # `copying', which is not final.
+    OUTCOME_CHOICES = (('copying', 'being copied'),
+                       ('imported', 'imported'),
+                       ('session_missing', 'session log not found'),
+                       ('session_empty', 'too few user turns'),
+                       ('copy_failed', 'failed to be copied'),
+                       ('save_failed', 'failed to be saved'),
+                       ('save_price_failed', 'failed to have its price saved'),
+                       ('dg_existed', 'existed already'),
+                       ('dg_updated', 'had its turn order updated'))
+
+    job = models.ForeignKey(ImportJob)
+    line_number = models.PositiveIntegerField()
+    """ index of the dialogue directory in the file list (from 0) """
+    src_fname = models.CharField(max_length=255)
+    """ path towards the dialogue directory """
+    cid = models.CharField(max_length=40, blank=True, default='')
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES)
+
+    class Meta(object):
+        unique_together = (('job', 'line_number'), )
+
+    def __unicode__(self):
+        return '({job}/{line}: {outcome})'.format(
+            job=self.job_id, line=self.line_number,
+            outcome=self.get_outcome_display())
+
+
 if USE_CF:
     class CrowdflowerJob(AbstractPriceClass):
         """
@@ -289,6 +408,52 @@ if USE_CF:
         def __unicode__(self):
             return '{job} ({price}c)'.format(job=self.job_id, price=self.cents)
 
+    class JudgmentCursor(models.Model):
+        """
+        Remembers how far judgments of a Crowdflower job have been collected.
+        """
+        job_id = models.CharField(max_length=8, unique=True)
+        """ ID of the Crowdflower job """
+        last_judgment_id = models.BigIntegerField(default=0)
+        """ the highest judgment ID (`_id') collected so far """
+        date_updated = models.DateTimeField(auto_now=True)
+
+        def __unicode__(self):
+            return '{job}: {judgment}'.format(job=self.job_id,
+                                              judgment=self.last_judgment_id)
+
+    class WorkerGoldStats(models.Model):
+        """
+        Running counts of gold items of a Crowdflower job that a worker has
+        attempted and missed.
+        """
+        job_id = models.CharField(max_length=8)
+        """ ID of the Crowdflower job """
+        worker_id = models.CharField(max_length=40)
+        """ ID of the Crowdflower worker """
+        n_gold = models.PositiveIntegerField(default=0)
+        n_missed = models.PositiveIntegerField(default=0)
+        logs_pending = models.BooleanField(default=False)
+        """ whether the score has yet to be recorded in session logs """
+
+        class Meta(object):
+            unique_together = (('job_id', 'worker_id'), )
+
+        def __unicode__(self):
+            return '{job}/{worker}: {missed}/{gold}'.format(
+                job=self.job_id, worker=self.worker_id, missed=self.n_missed,
+                gold=self.n_gold)
+
+        @property
+        def gold_score(self):
+            """
+            The ratio of gold items the worker got right to all gold items
+            they attempted, or -1 if they attempted none.
+            """
+            if self.n_gold == 0:
+                return -1.
+            return 1. - float(self.n_missed) / self.n_gold
+
 # If not using CrowdFlower,
 else:
     class PriceClass(AbstractPriceClass):
@@ -1,11 +1,24 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+import copy
 from datetime import datetime, timedelta
 from lxml import etree
+import multiprocessing
 import os
 import os.path
+import shutil
+import stat
+import sys
+import tempfile
+from threading import local, Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import settings
 
@@ -19,6 +32,11 @@ UserTurnAbs_nt = namedtuple(
     ['turn_abs_number', 'turn_number', 'wav_fname', 'asr_hyp', 'slu_hyp'])
 SystemTurnAbs_nt = namedtuple('SystemTurnAbs_nt', ['turn_abs_number',
                                                    'turn_number', 'text'])
+# An entry of the index of user turns in a session.  All the attributes are
+# lists of XML elements: user turns with the same turn number, their
+# transcription elements, and ASR and SLU hypotheses container elements,
+# respectively.
+UTurnIndex_nt = namedtuple('UTurnIndex_nt', ['turns', 'trss', 'asrs', 'slus'])
 
 WorkerIDStats = namedtuple('WorkerIDStats',
                            ['cid', 'n_kept_full', 'n_conflicting', 'n_updated',
@@ -29,11 +47,298 @@ DT_MATCH_TOL = timedelta(minutes=9999)
 CF_TD_SHIFT = timedelta(hours=-2)
 
 
+# Per-thread state of the deferred fsync batch mode.
+_fsync_batch = local()
+
+
+@contextmanager
+def deferred_fsync():
+    """
+    A context manager for bulk updates of session files.  Session files
+    written inside it are still synced to the disk before they replace the
+    old ones, but their directories are not synced one by one.  Instead, each
+    of them gets synced once, when the context is left.  All of them are
+    synced even if some fail to; the first error is raised then.
+
+    """
+    if getattr(_fsync_batch, 'dirnames', None) is not None:
+        # Already in the batch mode.
+        yield
+        return
+    _fsync_batch.dirnames = set()
+    try:
+        yield
+    finally:
+        dirnames = _fsync_batch.dirnames
+        _fsync_batch.dirnames = None
+        first_exc_info = None
+        for dirname in dirnames:
+            try:
+                _fsync_path(dirname)
+            except OSError:
+                if first_exc_info is None:
+                    first_exc_info = sys.exc_info()
+        if first_exc_info is not None:
+            raise first_exc_info[0], first_exc_info[1], first_exc_info[2]
+
+
+# Per-thread state of the batched sessions mode.
+_session_batch = local()
+
+
+@contextmanager
+def batched_sessions():
+    """
+    A context manager for a unit of work that changes session files
+    repeatedly.  All XMLSessions for the same session file opened (in this
+    thread) inside it share a single XML tree, and every session file that
+    was modified is written just once, when the context is left.  If an
+    exception is raised inside the context, no session file gets written.
+
+    To keep the database and the session files consistent, enter
+    a transaction right inside this context, like this:
+
+        with batched_sessions(), transaction.commit_on_success():
+            ...
+
+    The session files are then written only after the transaction has been
+    committed successfully.
+
+    """
+    if getattr(_session_batch, 'sessions', None) is not None:
+        # Already in the batched mode.
+        yield
+        return
+    _session_batch.sessions = OrderedDict()  # :: {path -> [XMLSession]}
+    try:
+        yield
+    except:
+        _session_batch.sessions = None
+        raise
+    batch = _session_batch.sessions
+    _session_batch.sessions = None
+    with deferred_fsync():
+        for sessions in batch.itervalues():
+            writers = [session for session in sessions
+                       if session.dirty and session.is_writable()]
+            if writers:
+                # The tree is the same for all of them.
+                writers[0].write()
+                for session in writers[1:]:
+                    session.index_new_annotations()
+
+
+def _fsync_path(path):
+    """Syncs a file or a directory to the disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_atomically(path, data):
+    """
+    Replaces the contents of the file at `path' with `data' so that readers
+    see either the old or the new contents, never a partially written file.
+
+    """
+    dirname = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.{fname}.'.format(fname=os.path.basename(path)),
+        suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            # The data must be on the disk before the file gets renamed, or a
+            # crash could leave an empty file in place of the old one.
+            os.fsync(tmp_file.fileno())
+        # Keep the permissions of the original file (mkstemp creates the file
+        # readable for the owner only).
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except OSError:
+            pass
+        # This is atomic on POSIX systems.
+        os.rename(tmp_path, path)
+    except:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    batch_dirnames = getattr(_fsync_batch, 'dirnames', None)
+    if batch_dirnames is None:
+        _fsync_path(dirname)
+    else:
+        batch_dirnames.add(dirname)
+
+
 def is_dialogue_dirname(fname):
     """Checks whether `fname' is a name of a known dialogue dir."""
     return os.path.isdir(os.path.join(settings.CONVERSATION_DIR, fname))
 
 
+def iter_annotation_attrs(cid):
+    """
+    Iterates over dialogue annotation elements of a session XML file without
+    building the XML tree of the whole session.  The file is parsed
+    incrementally, elements are discarded as soon as they have been read, and
+    parsing stops right after the annotations have been read if they precede
+    the turns.
+
+    Arguments:
+        cid -- name of the dialogue directory
+
+    Yields a dictionary of attributes for each annotation element.
+
+    """
+    sess_path = XMLSession.find_session_fname(
+        os.path.join(settings.CONVERSATION_DIR, cid))
+
+    anns_elem = anns_after = None
+    depth = 0
+    cur_anns = None  # the annotations element being read (if any)
+    last_anns = None  # attributes of annotations from the last child read
+    for event, el in etree.iterparse(sess_path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            # Find out what the annotations look like from the root element.
+            if depth == 1:
+                setup = dict(settings.XML_SCHEMES.get(el.tag, ()))
+                setup.update(getattr(settings, 'XML_COMMON', ()))
+                if setup.get('ANNOTATIONS_ABOVE') != '.':
+                    break
+                anns_elem = setup['ANNOTATIONS_ELEM']
+                anns_after = setup['ANNOTATIONS_AFTER']
+            # Check every child of the root element.
+            elif depth == 2:
+                if el.tag == anns_after:
+                    # The annotations are just before this element.
+                    for attrs in (last_anns or ()):
+                        yield attrs
+                    return
+                last_anns = None
+                if el.tag == anns_elem:
+                    cur_anns = el
+                    last_anns = list()
+        else:
+            depth -= 1
+            if depth == 2 and el.getparent() is cur_anns:
+                last_anns.append(dict(el.attrib))
+            elif depth == 1:
+                cur_anns = None
+                # Discard the element and anything preceding it.
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            elif depth == 0:
+                # The annotations are the last child of the root element.
+                for attrs in (last_anns or ()):
+                    yield attrs
+                return
+
+    # If the annotations cannot be found by streaming, parse the whole file.
+    with XMLSession(cid=cid, mode='r') as session:
+        for ann_el in session.iter_annotations():
+            yield dict(ann_el.attrib)
+
+
+# Per-process state of the sweep workers: the function applied to each item
+# and the extra arguments passed to it.
+_sweep_task = None
+# Per-thread number of sweep worker processes set by `parallel_sweeps'.
+_sweep_conf = local()
+
+
+@contextmanager
+def parallel_sweeps(n_procs=None):
+    """
+    A context manager for long-running jobs, such as management commands,
+    that lets sweeps inside it (see `sweep') shard their items across a pool
+    of worker processes.  Elsewhere, e.g. in web requests, sweeps use
+    settings.SWEEP_PROCESSES, which is 1 (serial) by default so that server
+    processes do not get forked.
+
+    Keyword arguments:
+        n_procs -- how many worker processes to use; None means as many as
+            there are CPUs
+
+    """
+    prev_n_procs = getattr(_sweep_conf, 'n_procs', None)
+    _sweep_conf.n_procs = n_procs or multiprocessing.cpu_count()
+    try:
+        yield
+    finally:
+        _sweep_conf.n_procs = prev_n_procs
+
+
+def _init_sweep_worker(func, args):
+    global _sweep_task
+    _sweep_task = (func, args)
+    # Each file is read once in a sweep, so parsed trees would only be
+    # copied for nothing.
+    _parsed_sessions.maxsize = 0
+    _parsed_sessions.clear()
+
+
+def _sweep_shard(items):
+    func, args = _sweep_task
+    with deferred_fsync():
+        return [func(item, *args) for item in items]
+
+
+def sweep(func, items, *args):
+    """
+    Applies a function to each of the items given, sharding the items across
+    a pool of worker processes if asked to (see `parallel_sweeps').  The items
+    are typically names of dialogue directories, each of them processed
+    independently.
+
+    Arguments:
+        func -- a module-level function to apply to each item; it is passed
+            the item followed by `args' and should return a small, picklable
+            result
+        items -- the items to process
+        args -- additional arguments to pass to `func'
+
+    Returns the list of results of `func', in the order of `items'.
+
+    """
+    items = list(items)
+    n_procs = getattr(_sweep_conf, 'n_procs', None)
+    if n_procs is None:
+        n_procs = settings.SWEEP_PROCESSES or multiprocessing.cpu_count()
+    n_procs = min(n_procs, len(items))
+    if n_procs <= 1:
+        with deferred_fsync(), _parsed_sessions.bypassed():
+            return [func(item, *args) for item in items]
+
+    # Make more shards than processes so that the load gets balanced.
+    n_shards = n_procs * 4
+    shard_size = -(-len(items) // n_shards)
+    shards = [items[start:start + shard_size]
+              for start in xrange(0, len(items), shard_size)]
+    pool = multiprocessing.Pool(n_procs, _init_sweep_worker, (func, args))
+    try:
+        shard_results = pool.map(_sweep_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for results in shard_results for result in results]
+
+
+def _update_worker_stats_dir(dg_dir, gold_stats):
+    # Skip sessions with no annotations by these workers.
+    if not any(attrs.get('user', '') == '' and
+               attrs.get('worker_id', None) in gold_stats
+               for attrs in iter_annotation_attrs(dg_dir)):
+        return 0
+    with XMLSession(cid=dg_dir) as session:
+        return session.update_worker_stats(gold_stats)
+
+
 def update_worker_stats(gold_stats):
     """Updates the gold hit statistic in all available session files.
 
@@ -46,17 +351,42 @@ def update_worker_stats(gold_stats):
 
     """
 
-    dg_dirs = filter(is_dialogue_dirname,
-                     os.listdir(settings.CONVERSATION_DIR))
-    n_files = 0
-    n_els = 0
-    for dg_dir in dg_dirs:
-        with XMLSession(cid=dg_dir) as session:
-            n_els += session.update_worker_stats(gold_stats)
-            n_files += (n_els > 0)
+    dg_dirs = _indexed_cids(_ann_index.cids_for_workers, gold_stats)
+    if dg_dirs is None:
+        dg_dirs = filter(is_dialogue_dirname,
+                         os.listdir(settings.CONVERSATION_DIR))
+    dir_n_els = sweep(_update_worker_stats_dir, dg_dirs, gold_stats)
+    n_files = sum(1 for n_els in dir_n_els if n_els > 0)
+    n_els = sum(dir_n_els)
     return n_files, n_els
 
 
+def _collect_worker_cers_dir(dg_dir, ann2w_cer):
+    dir_wids = list()
+    dir_wid2cers = dict()  # :: {worker_id -> [character error rate]}
+    for ann_attrs in iter_annotation_attrs(dg_dir):
+        ann_id = int(ann_attrs['id'])
+        worker_id = ann_attrs.get('worker_id', None)
+        if worker_id is not None:
+            dir_wids.append(worker_id)
+            if ann_id in ann2w_cer:
+                ann_cers = ann2w_cer[ann_id]
+                dir_wid2cers.setdefault(worker_id, list()).extend(ann_cers)
+    return dir_wids, dir_wid2cers
+
+
+def _update_worker_cers_dir(dg_dir, wid2cer_str):
+    n_els = 0
+    with XMLSession(cid=dg_dir) as session:
+        for ann_el in session.iter_annotations():
+            worker_id = ann_el.get('worker_id', None)
+            if worker_id in wid2cer_str:
+                session.set_attr(ann_el, 'avg_char_er',
+                                 wid2cer_str[worker_id])
+                n_els += 1
+    return n_els
+
+
 def update_worker_cers(ann2w_cer):
     """Updates the gold hit statistic in all available session files.
 
@@ -71,23 +401,19 @@ def update_worker_cers(ann2w_cer):
 
     """
 
-    dg_dirs = filter(is_dialogue_dirname,
-                     os.listdir(settings.CONVERSATION_DIR))
+    # Only look at directories with the annotations in question, if we can.
+    dg_dirs = _indexed_cids(_ann_index.cids_for_anns, ann2w_cer)
+    if dg_dirs is None:
+        dg_dirs = filter(is_dialogue_dirname,
+                         os.listdir(settings.CONVERSATION_DIR))
 
     # Build the mapping worker_id -> char_er.
     wid2cers = dict()  # :: {worker_id -> [character error rate]}
     dir2wids = dict()  # :: {dir -> [worker ID]}
-    for dg_dir in dg_dirs:
-        dir_wids = list()
-        with XMLSession(cid=dg_dir) as session:
-            for ann_el in session.iter_annotations():
-                ann_id = int(ann_el.get('id'))
-                worker_id = ann_el.get('worker_id', None)
-                if worker_id is not None:
-                    dir_wids.append(worker_id)
-                    if ann_id in ann2w_cer:
-                        ann_cers = ann2w_cer[ann_id]
-                        wid2cers.setdefault(worker_id, list()).extend(ann_cers)
+    dir_results = sweep(_collect_worker_cers_dir, dg_dirs, ann2w_cer)
+    for dg_dir, (dir_wids, dir_wid2cers) in zip(dg_dirs, dir_results):
+        for worker_id, cers in dir_wid2cers.iteritems():
+            wid2cers.setdefault(worker_id, list()).extend(cers)
         dir2wids[dg_dir] = dir_wids
 
     # Compute the average character error rate over all error rates for each
@@ -96,25 +422,64 @@ def update_worker_cers(ann2w_cer):
                    for wid, cers in wid2cers.iteritems()}
 
     # Determine which directories we need to visit again.
-    affected_dirs = [dg_dir for dg_dir in dir2wids
-                     if any((wid in wid2cer_str) for wid in dir2wids[dg_dir])]
+    affected_dirs = _indexed_cids(_ann_index.cids_for_workers, wid2cer_str)
+    if affected_dirs is None:
+        affected_dirs = [dg_dir for dg_dir in dir2wids
+                         if any((wid in wid2cer_str)
+                                for wid in dir2wids[dg_dir])]
 
     # Update the average error rates in the logs.
-    n_files = len(affected_dirs)
-    n_els = 0
+    dir_n_els = sweep(_update_worker_cers_dir, affected_dirs, wid2cer_str)
+    n_files = sum(1 for n_els in dir_n_els if n_els > 0)
+    n_els = sum(dir_n_els)
     n_workers = len(wid2cer_str)
-    for dg_dir in affected_dirs:
-        with XMLSession(cid=dg_dir) as session:
-            for ann_el in session.iter_annotations():
-                worker_id = ann_el.get('worker_id', None)
-                if worker_id in wid2cer_str:
-                    ann_el.set('avg_char_er', wid2cer_str[worker_id])
-                    n_els += 1
 
     # Return.
     return n_files, n_workers, n_els
 
 
+def _collect_cookies_dir(dg_dir):
+    needs_be_filled = False
+    dir_cookie2ids = dict()  # :: {cookie -> {worker_id -> count}}
+    for ann_attrs in iter_annotation_attrs(dg_dir):
+        cookie = ann_attrs.get(settings.TRANSCRIBER_ID_ATTR, None)
+        if cookie is not None:
+            wid = ann_attrs.get('worker_id', None)
+            needs_be_filled |= (wid is None)
+            cookie_ids = dir_cookie2ids.setdefault(cookie, dict())
+            cookie_ids[wid] = cookie_ids.get(wid, 0) + 1
+    return needs_be_filled, dir_cookie2ids
+
+
+def _fill_in_worker_ids_dir(cid, cookie2id, force):
+    n_kept_full = n_conflicting = n_updated = n_kept_empty = 0
+    with XMLSession(cid=cid) as session:
+        for ann in session.iter_annotations():
+            cookie = ann.get(settings.TRANSCRIBER_ID_ATTR, None)
+            wid = ann.get('worker_id', None)
+            # If a worker ID has been assigned to this annotation,
+            if wid is not None:
+                # Check whether it is not in contrary to what we would
+                # put there based on the cookie.
+                conflicts = (cookie2id.get(cookie, wid) != wid)
+                if conflicts:
+                    n_conflicting += 1
+                    if force:
+                        session.set_attr(ann, 'worker_id', cookie2id[cookie])
+                else:
+                    n_kept_full += 1
+            # If no worker ID has been assigned to this annotation,
+            else:
+                # If we know the worker ID that should be here,
+                if cookie in cookie2id:
+                    session.set_attr(ann, 'worker_id', cookie2id[cookie])
+                    n_updated += 1
+                else:
+                    n_kept_empty += 1
+    return WorkerIDStats(cid, n_kept_full, n_conflicting, n_updated,
+                         n_kept_empty)
+
+
 def fill_in_worker_ids(force=False):
     """
     Uses cookie IDs stored with annotations to fill in worker IDs to
@@ -146,15 +511,12 @@ def fill_in_worker_ids(force=False):
                         #     n_kept_empty)
 
     # First pass: collect the mapping cookie -> worker_id.
-    for dg_dir in dg_dirs:
-        needs_be_filled = False
-        with XMLSession(cid=dg_dir) as session:
-            for ann in session.iter_annotations():
-                cookie = ann.get(settings.TRANSCRIBER_ID_ATTR, None)
-                if cookie is not None:
-                    wid = ann.get('worker_id', None)
-                    needs_be_filled |= (wid is None)
-                    cookie2ids[cookie][wid] += 1
+    dir_results = sweep(_collect_cookies_dir, dg_dirs)
+    for dg_dir, (needs_be_filled, dir_cookie2ids) in zip(dg_dirs,
+                                                         dir_results):
+        for cookie, ids in dir_cookie2ids.iteritems():
+            for wid, n_occs in ids.iteritems():
+                cookie2ids[cookie][wid] += n_occs
         if needs_be_filled:
             cids_to_fill.append(dg_dir)
 
@@ -187,55 +549,478 @@ def fill_in_worker_ids(force=False):
             ambig_cookies.add(cookie)
 
     # Second pass: fill in worker_ids which we can deduce.
-    for cid in cids_to_fill:
-        n_kept_full = n_conflicting = n_updated = n_kept_empty = 0
-        with XMLSession(cid=cid) as session:
-            for ann in session.iter_annotations():
-                cookie = ann.get(settings.TRANSCRIBER_ID_ATTR, None)
-                wid = ann.get('worker_id', None)
-                # If a worker ID has been assigned to this annotation,
-                if wid is not None:
-                    # Check whether it is not in contrary to what we would put
-                    # there based on the cookie.
-                    conflicts = (cookie2id.get(cookie, wid) != wid)
-                    if conflicts:
-                        n_conflicting += 1
-                        if force:
-                            ann.set('worker_id', cookie2id[cookie])
-                    else:
-                        n_kept_full += 1
-                # If no worker ID has been assigned to this annotation,
-                else:
-                    # If we know the worker ID that should be here,
-                    if cookie in cookie2id:
-                        ann.set('worker_id', cookie2id[cookie])
-                        n_updated += 1
-                    else:
-                        n_kept_empty += 1
-        cid_stats.append(WorkerIDStats(cid, n_kept_full, n_conflicting,
-                                       n_updated, n_kept_empty))
+    cid_stats.extend(sweep(_fill_in_worker_ids_dir, cids_to_fill,
+                           cookie2id, force))
 
     return ambig_cookies, resolved_cookies, cid_stats
 
 
+def _record_judgments_dir(cid_anns):
+    cid, dg_anns = cid_anns
+    msgs = list()
+    with XMLSession(cid=cid) as session:
+        for judgment in dg_anns:
+            try:
+                session.record_judgment(judgment, match_date=True)
+            except Exception as ex:
+                msgs.append('{fname}: {ex}'.format(fname=session.sess_path,
+                                                   ex=ex))
+    return msgs
+
+
 def record_judgments(dgs_anns):
     dg_dirs = set(filter(is_dialogue_dirname,
                          os.listdir(settings.CONVERSATION_DIR)))
-    for cid, dg_anns in dgs_anns.iteritems():
-        if cid in dg_dirs:
-            with XMLSession(cid=cid) as session:
-                for judgment in dg_anns:
-                    try:
-                        session.record_judgment(judgment, match_date=True)
-                    except Exception as ex:
-                        print '{fname}: {ex}'.format(fname=session.sess_path,
-                                                     ex=ex)
+    cids_anns = [(cid, dg_anns) for cid, dg_anns in dgs_anns.iteritems()
+                 if cid in dg_dirs]
+    for msgs in sweep(_record_judgments_dir, cids_anns):
+        for msg in msgs:
+            print msg
 
 
 class FileNotFoundError(Exception):
     pass
 
 
+class _ParsedSessionCache(object):
+    """
+    A process-wide, size-bounded cache of parsed session XML files.
+
+    Entries are keyed by the path of the file and are valid only as long as
+    the file's inode, size, modification and status change times stay the
+    same.  Trees are handed out as deep copies so that callers can modify them
+    freely.  The cache can be bypassed in a thread (see `bypassed'), e.g. by
+    sweeps, which read each file once.
+
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._trees = OrderedDict()  # :: {path -> (stat key, tree)}
+        self._lock = Lock()
+        self._bypass = local()
+
+    @staticmethod
+    def _stat_key(path_stat):
+        return (path_stat.st_dev, path_stat.st_ino, path_stat.st_size,
+                path_stat.st_mtime, path_stat.st_ctime)
+
+    @contextmanager
+    def bypassed(self):
+        """
+        A context manager inside which the current thread neither looks up
+        nor stores any trees.
+
+        """
+        prev_bypass = getattr(self._bypass, 'on', False)
+        self._bypass.on = True
+        try:
+            yield
+        finally:
+            self._bypass.on = prev_bypass
+
+    def _disabled(self):
+        return not self.maxsize or getattr(self._bypass, 'on', False)
+
+    def get(self, path):
+        """
+        Returns a copy of the cached tree for `path', or None if the cache
+        holds no valid tree for it.
+
+        """
+        if self._disabled():
+            return None
+        path_stat = os.stat(path)
+        with self._lock:
+            entry = self._trees.pop(path, None)
+            if entry is None:
+                return None
+            stat_key, tree = entry
+            if stat_key != self._stat_key(path_stat):
+                return None
+            # Record recent use of this entry.
+            self._trees[path] = entry
+        return copy.deepcopy(tree)
+
+    def put(self, path, tree, path_stat):
+        """
+        Stores a copy of `tree' parsed from `path' whose stat (as of before
+        parsing) was `path_stat'.
+
+        """
+        if self._disabled():
+            return
+        entry = (self._stat_key(path_stat), copy.deepcopy(tree))
+        with self._lock:
+            self._trees.pop(path, None)
+            self._trees[path] = entry
+            while len(self._trees) > self.maxsize:
+                self._trees.popitem(last=False)
+
+    def discard(self, path):
+        with self._lock:
+            self._trees.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+
+_parsed_sessions = _ParsedSessionCache(settings.SESSION_CACHE_SIZE)
+
+
+class _AnnotationIndex(object):
+    """
+    An on-disk index of dialogue directories by the worker IDs and IDs of
+    annotations found in their session files.
+
+    The index consists of append-only files with one tab-separated entry per
+    line.  Entries are only removed when the index is rebuilt, so the index
+    can list a directory that no longer contains the worker or annotation
+    (e.g. after its worker ID was overwritten), but once it is complete, it
+    never misses one.  The index is complete when it has been built by
+    `rebuild_ann_index'; until then, lookups return None.
+
+    Each process reads the index files into memory on the first lookup, and
+    then reads only the entries appended since.
+
+    """
+    WORKERS_FNAME = 'worker_cids'
+    ANNS_FNAME = 'ann_cids'
+    COMPLETE_FNAME = 'complete'
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._lock_path = (os.path.abspath(dirname) + '.lock' if dirname
+                           else None)
+        # Entries read from the index files so far.
+        self._loaded = dict()  # :: {fname -> (file ID, offset, entries)}
+        self._lock = Lock()
+
+    def _path(self, fname, dirname=None):
+        return os.path.join(dirname or self.dirname, fname)
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        """
+        A context manager that holds a lock on the index shared by all
+        processes: a shared one for adding entries, or an exclusive one for
+        replacing the index.
+
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file,
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def is_complete(self):
+        return (bool(self.dirname) and
+                os.path.exists(self._path(self.COMPLETE_FNAME)))
+
+    def _append(self, fname, cid, keys):
+        lines = ''.join(u'{key}\t{cid}\n'.format(key=key, cid=cid)
+                        .encode('UTF-8') for key in keys)
+        if lines:
+            # A single write to a file opened for appending does not get
+            # interleaved with writes from other processes.
+            with open(self._path(fname), 'a') as index_file:
+                index_file.write(lines)
+
+    def add(self, cid, worker_ids=(), ann_ids=()):
+        """
+        Records that the session file in the dialogue directory `cid'
+        contains annotations by the given workers and with the given IDs.
+
+        """
+        if (self.dirname and (worker_ids or ann_ids) and
+                os.path.isdir(os.path.dirname(self._lock_path))):
+            with self.locked():
+                if os.path.isdir(self.dirname):
+                    self._append(self.WORKERS_FNAME, cid, worker_ids)
+                    self._append(self.ANNS_FNAME, cid, ann_ids)
+
+    def size(self, fname):
+        """Returns the size of an index file, or 0 if there is none."""
+        try:
+            return os.path.getsize(self._path(fname))
+        except OSError:
+            return 0
+
+    def read(self, fname, offset=0):
+        """
+        Yields tuples (end offset, key, cid) for entries of an index file from
+        `offset' on.  An entry being appended just now is left out.
+
+        """
+        try:
+            index_file = open(self._path(fname))
+        except IOError:
+            return
+        with index_file:
+            index_file.seek(offset)
+            for line in index_file:
+                if not line.endswith('\n'):
+                    break
+                offset += len(line)
+                key, _, cid = line.decode('UTF-8')[:-1].partition('\t')
+                yield offset, key, cid
+
+    def _entries(self, fname):
+        # Call this with `self._lock' held.
+        try:
+            index_stat = os.stat(self._path(fname))
+        except OSError:
+            return dict()
+        file_id = (index_stat.st_dev, index_stat.st_ino)
+        loaded = self._loaded.get(fname)
+        # Read the file from the start if it has been replaced.
+        if (loaded is None or loaded[0] != file_id or
+                loaded[1] > index_stat.st_size):
+            loaded = (file_id, 0, dict())  # entries :: {key -> set(cid)}
+        _, offset, entries = loaded
+        for offset, key, cid in self.read(fname, offset):
+            entries.setdefault(key, set()).add(cid)
+        self._loaded[fname] = (file_id, offset, entries)
+        return entries
+
+    def _lookup(self, fname, keys):
+        if not self.is_complete():
+            return None
+        cids = set()
+        with self._lock:
+            entries = self._entries(fname)
+            for key in keys:
+                cids.update(entries.get(unicode(key), ()))
+        return filter(is_dialogue_dirname, cids)
+
+    def cids_for_workers(self, worker_ids):
+        """
+        Returns names of dialogue directories that contain annotations by any
+        of the workers given, or None if the index is not complete.
+
+        """
+        return self._lookup(self.WORKERS_FNAME, worker_ids)
+
+    def cids_for_anns(self, ann_ids):
+        """
+        Returns names of dialogue directories that contain any of the
+        annotations given (by their IDs), or None if the index is not
+        complete.
+
+        """
+        return self._lookup(self.ANNS_FNAME, ann_ids)
+
+    def replace(self, entries, offsets):
+        """
+        Replaces the index with a complete one containing the entries given.
+        The new index is written to a temporary directory and renamed into
+        place under the exclusive lock.  Entries added to the old index since
+        the new ones were collected are carried over.
+
+        Arguments:
+            entries -- a mapping {fname -> set((key, cid))}; the sets get
+                updated
+            offsets -- a mapping {fname -> size of the index file when the
+                entries started to be collected}
+
+        """
+        index_dir = self.dirname.rstrip(os.sep)
+        parent_dir = os.path.dirname(os.path.abspath(index_dir))
+        new_dir = tempfile.mkdtemp(prefix='.ann_index.', dir=parent_dir)
+        old_dir = None
+        try:
+            os.chmod(new_dir, stat.S_IMODE(os.stat(index_dir).st_mode))
+            with self.locked(exclusive=True):
+                for fname, fname_entries in entries.iteritems():
+                    fname_entries.update(
+                        (key, cid)
+                        for _, key, cid in self.read(fname, offsets[fname]))
+                    lines = (u'{key}\t{cid}\n'.format(key=key, cid=cid)
+                             .encode('UTF-8')
+                             for key, cid in sorted(fname_entries))
+                    with open(self._path(fname, new_dir), 'w') as index_file:
+                        index_file.writelines(lines)
+                open(self._path(self.COMPLETE_FNAME, new_dir), 'a').close()
+                # Move the old index away (over an empty directory), and the
+                # new one in its place.
+                old_dir = tempfile.mkdtemp(prefix='.ann_index.',
+                                           dir=parent_dir)
+                os.rename(index_dir, old_dir)
+                os.rename(new_dir, index_dir)
+                new_dir = None
+        finally:
+            for dirname in (new_dir, old_dir):
+                if dirname is not None:
+                    shutil.rmtree(dirname, ignore_errors=True)
+
+
+_ann_index = _AnnotationIndex(settings.ANN_INDEX_DIR)
+
+
+def _collect_ann_keys(cid):
+    worker_ids = set()
+    ann_ids = set()
+    for ann_attrs in iter_annotation_attrs(cid):
+        if 'id' in ann_attrs:
+            ann_ids.add(ann_attrs['id'])
+        if 'worker_id' in ann_attrs:
+            worker_ids.add(ann_attrs['worker_id'])
+    return worker_ids, ann_ids
+
+
+def index_annotations(cid):
+    """
+    Adds all annotations from the session file of a dialogue directory to the
+    annotation index.
+
+    Arguments:
+        cid -- name of the dialogue directory
+
+    Returns the number of annotations found, or 0 if there is no index
+    configured (in which case the session file is not read at all).
+
+    """
+    if not settings.ANN_INDEX_DIR:
+        return 0
+    worker_ids, ann_ids = _collect_ann_keys(cid)
+    _ann_index.add(cid, worker_ids, ann_ids)
+    return len(ann_ids)
+
+
+def rebuild_ann_index():
+    """
+    Builds the annotation index anew from all available session files and
+    marks it as complete.  Lookups keep using the old index until the new one
+    replaces it.  Does nothing unless ANN_INDEX_DIR is configured.  This is
+    run by the `rebuild_ann_index' management command.
+
+    Returns a tuple (number of files indexed, number of annotations indexed),
+    or None if there is no index configured.
+
+    """
+    if not settings.ANN_INDEX_DIR:
+        return None
+    # Make sure the index is there for entries added meanwhile to go to.
+    if not os.path.isdir(settings.ANN_INDEX_DIR):
+        os.makedirs(settings.ANN_INDEX_DIR)
+    fnames = (_AnnotationIndex.WORKERS_FNAME, _AnnotationIndex.ANNS_FNAME)
+    offsets = {fname: _ann_index.size(fname) for fname in fnames}
+
+    dg_dirs = filter(is_dialogue_dirname,
+                     os.listdir(settings.CONVERSATION_DIR))
+    entries = {fname: set() for fname in fnames}
+    n_anns = 0
+    for cid, (worker_ids, ann_ids) in zip(
+            dg_dirs, sweep(_collect_ann_keys, dg_dirs)):
+        entries[_AnnotationIndex.WORKERS_FNAME].update(
+            (worker_id, cid) for worker_id in worker_ids)
+        entries[_AnnotationIndex.ANNS_FNAME].update(
+            (ann_id, cid) for ann_id in ann_ids)
+        n_anns += len(ann_ids)
+    _ann_index.replace(entries, offsets)
+    return len(dg_dirs), n_anns
+
+
+def _indexed_cids(lookup, keys):
+    """
+    Returns names of dialogue directories listed in the annotation index for
+    `keys' (using the index method `lookup').  Returns None if there is no
+    index configured or it has not been built yet, in which case all the
+    directories need to be scanned.
+
+    """
+    if not settings.ANN_INDEX_DIR:
+        return None
+    return lookup(keys)
+
+
+class _XMLScheme(object):
+    """
+    Configuration of one XML scheme of session files, as given by
+    settings.XML_SCHEMES and settings.XML_COMMON, together with everything
+    derived from it.  One object is built for each root tag and shared by all
+    sessions using that scheme.
+
+    """
+    _schemes = dict()  # :: {root tag -> _XMLScheme}
+    _lock = Lock()
+
+    @classmethod
+    def for_root_tag(cls, root_tag):
+        """
+        Returns the scheme for session files with the given root tag, or
+        None if no scheme is configured for it.
+
+        """
+        try:
+            return cls._schemes[root_tag]
+        except KeyError:
+            pass
+        with cls._lock:
+            if root_tag not in cls._schemes:
+                if root_tag not in settings.XML_SCHEMES:
+                    return None
+                cls._schemes[root_tag] = cls(settings.XML_SCHEMES[root_tag])
+            return cls._schemes[root_tag]
+
+    def __init__(self, setup):
+        # Set all the specific XML configuration options here.
+        for key, val in setup.iteritems():
+            setattr(self, key, val)
+        # Set all the common XML configuration options here.
+        if hasattr(settings, 'XML_COMMON'):
+            for key, val in settings.XML_COMMON.iteritems():
+                setattr(self, key, val)
+
+        self.SLASH_TRANSCRIPTIONS_ELEM = (("/" + self.TRANSCRIPTIONS_ELEM)
+                                          if self.TRANSCRIPTIONS_ELEM else "")
+        self.SLASH_ASRHYPS_ELEM = (
+            ("/" + self.ASRHYPS_ELEM) if self.ASRHYPS_ELEM else "")
+        self.SLASH_SLUHYPS_ELEM = (
+            ("/" + self.SLUHYPS_ELEM) if self.SLUHYPS_ELEM else "")
+        if getattr(self, 'DATE_FORMAT', None) is None:
+            self.DATE_FORMAT = None
+
+        # Compile the XPath expressions for finding turns.
+        self.userturn_xpath = etree.XPath(self.USERTURN_PATH)
+        self.systurn_xpath = etree.XPath(self.SYSTURN_PATH)
+        self.turns_xpath = etree.XPath(
+            '|'.join((self.USERTURN_PATH, self.SYSTURN_PATH)))
+        # Compile the XPath expressions for finding elements within a user
+        # turn.
+        trss_path = ".{trss}/{trs}".format(trss=self.SLASH_TRANSCRIPTIONS_ELEM,
+                                            trs=self.TRANSCRIPTION_ELEM)
+        self.trss_xpath = etree.XPath(trss_path)
+        # (The "annotation" attribute is hard-wired in views.py, too.)
+        self.trss_by_ann_xpath = etree.XPath(trss_path + "[@annotation=$ann]")
+        self.trss_by_author_ann_xpath = etree.XPath(
+            "{trss}[@{author}=$author][@annotation=$ann]".format(
+                trss=trss_path, author=self.AUTHOR_ATTR))
+        self.asrs_xpath = etree.XPath("." + self.SLASH_ASRHYPS_ELEM)
+        self.slus_xpath = etree.XPath("." + self.SLASH_SLUHYPS_ELEM)
+        self.asrhyp_xpath = etree.XPath(self.ASRHYP_ELEM)
+        self.sluhyp_xpath = etree.XPath(self.SLUHYP_ELEM)
+
+    _iso_format = '%Y-%m-%d %H:%M:%S.%f'
+    _iso_format0 = '%Y-%m-%d %H:%M:%S'  # in case microsecond == 0
+
+    def format_datetime(self, dt):
+        if self.DATE_FORMAT is not None:
+            return dt.strftime(self.DATE_FORMAT)
+        return unicode(dt)
+
+    def parse_datetime(self, dt_str):
+        if self.DATE_FORMAT is not None:
+            return datetime.strptime(dt_str, self.DATE_FORMAT)
+        try:
+            return datetime.strptime(dt_str, self._iso_format)
+        except ValueError:
+            return datetime.strptime(dt_str, self._iso_format0)
+
+
 class XMLSession(object):
     """
     A context manager for handling XML files capturing dialogue sessions.
@@ -273,75 +1058,190 @@ class XMLSession(object):
             self.dirname = os.path.dirname(self.sess_path)
         self.mode = mode
         self.sess_xml = None
+        self.dirty = False
+        # Name of the dialogue directory if it is one of the managed ones.
+        if (os.path.dirname(os.path.abspath(self.dirname)) ==
+                os.path.abspath(settings.CONVERSATION_DIR)):
+            self.cid = os.path.basename(os.path.abspath(self.dirname))
+        else:
+            self.cid = None
+        # Worker and annotation IDs to add to the annotation index once the
+        # session is written.
+        self._new_worker_ids = set()
+        self._new_ann_ids = set()
 
-    def __enter__(self):
+    def _parse(self):
+        """
+        Parses the session file, using the parsed sessions cache.  Trees
+        parsed for writing are not stored in the cache as the file is likely
+        to change.
+
+        """
+        sess_xml = _parsed_sessions.get(self.sess_path)
+        if sess_xml is not None:
+            return sess_xml
+
+        path_stat = os.stat(self.sess_path)
         with open(self.sess_path, self.mode) as sess_file:
             try:
-                self.sess_xml = etree.parse(sess_file, self.xml_parser)
+                sess_xml = etree.parse(sess_file, self.xml_parser)
             except:
                 raise ValueError(('The session XML file {fname} cannot be parsed.').format(fname=self.sess_path))
-        
+        if not self.is_writable():
+            _parsed_sessions.put(self.sess_path, sess_xml, path_stat)
+        return sess_xml
+
+    def __enter__(self):
+        batch = getattr(_session_batch, 'sessions', None)
+        if batch is None:
+            self.sess_xml = self._parse()
+        else:
+            # Share the tree with other sessions for this file in the batch.
+            sessions = batch.setdefault(self.sess_path, list())
+            if sessions:
+                self.sess_xml = sessions[0].sess_xml
+            else:
+                self.sess_xml = self._parse()
+        self.dirty = False
+
         # Check the version of the session XML scheme and set all the XML
         # orientation variables.
         # TODO Implement a more comprehensive scheme for determining the XML
         # scheme.
-        root_tag = self.sess_xml.getroot().tag
-        try:
-            setup = settings.XML_SCHEMES[root_tag]
-        except:
+        self.scheme = _XMLScheme.for_root_tag(self.sess_xml.getroot().tag)
+        if self.scheme is None:
             raise ValueError(('The session XML file {fname} does not conform '
                               'to any XML schemes configured.').format(
                              fname=self.sess_path))
 
-        # Set all the specific XML configuration options here.
-        for key, val in setup.iteritems():
-            self.__setattr__(key, val)
-        # Set all the common XML configuration options here.
-        if hasattr(settings, 'XML_COMMON'):
-            for key, val in settings.XML_COMMON.iteritems():
-                self.__setattr__(key, val)
-
-        self.SLASH_TRANSCRIPTIONS_ELEM = (("/" + self.TRANSCRIPTIONS_ELEM)
-                                          if self.TRANSCRIPTIONS_ELEM else "")
-        self.SLASH_ASRHYPS_ELEM = (
-            ("/" + self.ASRHYPS_ELEM) if self.ASRHYPS_ELEM else "")
-        self.SLASH_SLUHYPS_ELEM = (
-            ("/" + self.SLUHYPS_ELEM) if self.SLUHYPS_ELEM else "")
-        if hasattr(self, 'DATE_FORMAT') and self.DATE_FORMAT is not None:
-            def format_datetime(dt):
-                return dt.strftime(self.DATE_FORMAT)
-            def parse_datetime(dt_str):
-                return datetime.strptime(dt_str, self.DATE_FORMAT)
+        # The index of user turns is built on the first turn lookup (see
+        # `_uturn_idx').  Sessions for the same file in a batch share it
+        # through the first of them, so that it stays up to date with changes
+        # made through any of the sessions.
+        self._uturn_idx_value = None
+        if batch is None or not sessions:
+            self._uturn_idx_owner = self
         else:
-            iso_format = '%Y-%m-%d %H:%M:%S.%f'
-            iso_format0 = '%Y-%m-%d %H:%M:%S'  # in case microsecond == 0
-            def format_datetime(dt):
-                return unicode(dt)
-            def parse_datetime(dt_str):
-                try:
-                    return datetime.strptime(dt_str, iso_format)
-                except ValueError:
-                    return datetime.strptime(dt_str, iso_format0)
-        self.format_datetime = format_datetime
-        self.parse_datetime = parse_datetime
+            self._uturn_idx_owner = sessions[0]._uturn_idx_owner
+        if batch is not None:
+            sessions.append(self)
 
         return self
 
+    def __getattr__(self, name):
+        # Look up the XML orientation variables in the scheme.
+        scheme = self.__dict__.get('scheme')
+        if scheme is None:
+            raise AttributeError(name)
+        return getattr(scheme, name)
+
     def __exit__(self, exc_type, exc_value, exc_tb):
         # Check whether an exception occurred.
         if exc_type is not None:
             # Simple behaviour: just reraise the exception.
             return False
 
-        if any(ltr in self.mode for ltr in 'aw+'):
-            with open(self.sess_path, 'w') as sess_file:
-                sess_file.write(etree.tostring(self.sess_xml,
-                                               pretty_print=True,
-                                               xml_declaration=True,
-                                               encoding='UTF-8'))
+        # In the batched mode, the file gets written at the end of the batch.
+        if getattr(_session_batch, 'sessions', None) is not None:
+            return True
+
+        # Write the file only if the tree has been changed.
+        if self.dirty and self.is_writable():
+            self.write()
 
         return True
 
+    def is_writable(self):
+        """Checks whether the session was opened for writing."""
+        return any(ltr in self.mode for ltr in 'aw+')
+
+    def write(self):
+        """Writes the XML tree back to the session file."""
+        _parsed_sessions.discard(self.sess_path)
+        _write_atomically(self.sess_path,
+                          etree.tostring(self.sess_xml,
+                                         pretty_print=True,
+                                         xml_declaration=True,
+                                         encoding='UTF-8'))
+        self.index_new_annotations()
+
+    def index_new_annotations(self):
+        """
+        Adds worker and annotation IDs newly written to this session to the
+        annotation index.
+
+        """
+        if self.cid is not None:
+            _ann_index.add(self.cid, self._new_worker_ids, self._new_ann_ids)
+
+    def mark_dirty(self):
+        """
+        Marks the session as modified, so that it gets written back to the
+        file on exit.  Call this after modifying the XML tree directly.
+
+        """
+        self.dirty = True
+
+    def set_attr(self, el, name, value):
+        """
+        Sets an attribute of an element of this session's XML tree, marking
+        the session as modified if the value has changed.
+
+        """
+        if el.get(name) != value:
+            el.set(name, value)
+            self.dirty = True
+            if name == 'worker_id':
+                self._new_worker_ids.add(value)
+
+    @property
+    def _uturn_idx(self):
+        """
+        The index of user turns by their turn number, built by
+        `_index_uturns' on the first access.  Sessions that never look up
+        a turn (e.g. ones only reading annotations) do not build it.
+
+        """
+        owner = self._uturn_idx_owner
+        if owner._uturn_idx_value is None:
+            owner._uturn_idx_value = owner._index_uturns()
+        return owner._uturn_idx_value
+
+    def _index_uturns(self):
+        """
+        Builds the index of user turns by their turn number, walking the XML
+        tree just once.  All lookups of user turns and their subelements by
+        the turn number are answered from this index.
+
+        Returns the index as a dictionary {turn number -> UTurnIndex_nt}.
+
+        """
+        uturn_idx = dict()
+        for uturn_el in self.userturn_xpath(self.sess_xml):
+            try:
+                turn_number = int(uturn_el.get(self.TURNNUMBER_ATTR))
+            except (TypeError, ValueError):
+                # Some turns in the XML logs don't have the turn number
+                # attribute.  Such turns cannot be looked up anyway.
+                continue
+            entry = uturn_idx.get(turn_number)
+            if entry is None:
+                entry = UTurnIndex_nt(list(), list(), list(), list())
+                uturn_idx[turn_number] = entry
+            entry.turns.append(uturn_el)
+            entry.trss.extend(self.trss_xpath(uturn_el))
+            entry.asrs.extend(self.asrs_xpath(uturn_el))
+            entry.slus.extend(self.slus_xpath(uturn_el))
+        return uturn_idx
+
+    def _find_uturn(self, turn_number):
+        """
+        Returns the first user turn element with the given turn number.
+        Raises KeyError if there is no such turn.
+
+        """
+        return self._uturn_idx[turn_number].turns[0]
+
     def find_asr_1best_for_turn(self, turn_number):
         """
         Returns the ASR hypothesis for a user turn with the given turn number
@@ -355,18 +1255,14 @@ class XMLSession(object):
 
         # Find all enclosing ASR hypothesis elements (the ASR hypotheses are
         # split over several such sometimes).
-        asrs_path = "{uturn}[@{turn_attr}='{turn}']{asrs}".format(
-            uturn=self.USERTURN_PATH,
-            turn_attr=self.TURNNUMBER_ATTR,
-            turn=str(turn_number),
-            asrs=self.SLASH_ASRHYPS_ELEM)
-        asrs_els = self.sess_xml.findall(asrs_path)
-        if not asrs_els:
+        entry = self._uturn_idx.get(int(turn_number))
+        if entry is None or not entry.asrs:
             return None
+        asrs_els = entry.asrs
 
         asr_subhyps = list()
         for asrs_el in asrs_els:
-            asr_els = asrs_el.findall(self.ASRHYP_ELEM)
+            asr_els = self.asrhyp_xpath(asrs_el)
             if not asr_els:
                 continue
             # Be robust against invalid asrhyp elements.
@@ -390,18 +1286,14 @@ class XMLSession(object):
 
         # Find all enclosing SLU hypothesis elements (the SLU hypotheses are
         # split over several such sometimes).
-        slus_path = "{uturn}[@{turn_attr}='{turn}']{slus}".format(
-            uturn=self.USERTURN_PATH,
-            turn_attr=self.TURNNUMBER_ATTR,
-            turn=str(turn_number),
-            slus=self.SLASH_SLUHYPS_ELEM)
-        slus_els = self.sess_xml.findall(slus_path)
-        if not slus_els:
+        entry = self._uturn_idx.get(int(turn_number))
+        if entry is None or not entry.slus:
             return None
+        slus_els = entry.slus
 
         slu_subhyps = list()
         for slus_el in slus_els:
-            slu_els = slus_el.findall(self.SLUHYP_ELEM)
+            slu_els = self.sluhyp_xpath(slus_el)
             if not slu_els:
                 continue
             # Be robust against invalid sluhyp elements.
@@ -427,13 +1319,10 @@ class XMLSession(object):
                 turn in question
 
         """
-        trs_path = "{uturn}[@{turn_attr}='{turn}']{trss}/{trs}".format(
-            uturn=self.USERTURN_PATH,
-            turn_attr=self.TURNNUMBER_ATTR,
-            turn=str(turn_number),
-            trss=self.SLASH_TRANSCRIPTIONS_ELEM,
-            trs=self.TRANSCRIPTION_ELEM)
-        return self.sess_xml.findall(trs_path)
+        entry = self._uturn_idx.get(int(turn_number))
+        if entry is None:
+            return list()
+        return list(entry.trss)
 
     def find_transcription(self, trs):
         """
@@ -450,29 +1339,21 @@ class XMLSession(object):
             username = dg_ann.user.username
         else:
             username = ''
-        trs_path = ("{uturn}[@{turn_attr}='{turn}']{trss}/{trs}"
-                    "[@{auth_attr}='{author}'][@{ann_attr}='{ann}']").format(
-                        uturn=self.USERTURN_PATH,
-                        turn_attr=self.TURNNUMBER_ATTR,
-                        turn=str(trs.turn.turn_number),
-                        trss=self.SLASH_TRANSCRIPTIONS_ELEM,
-                        trs=self.TRANSCRIPTION_ELEM,
-                        auth_attr=self.AUTHOR_ATTR,
-                        author=username,
-                        ann_attr="annotation",  # hard-wired in views.py, too
-                        ann=str(dg_ann.pk))
-        return self.sess_xml.find(trs_path)
+        entry = self._uturn_idx.get(int(trs.turn.turn_number))
+        if entry is None:
+            return None
+        for uturn_el in entry.turns:
+            trs_els = self.trss_by_author_ann_xpath(uturn_el, author=username,
+                                                    ann=str(dg_ann.pk))
+            if trs_els:
+                return trs_els[0]
+        return None
 
     def add_transcription(self, trs):
 
         # Find the appropriate place for the transcription in the XML tree.
         dg_ann = trs.dialogue_annotation
-        user_turns = self.sess_xml.findall(self.USERTURN_PATH)
-        turn_xml = filter(
-            lambda turn_xml: \
-                int(turn_xml.get(self.TURNNUMBER_ATTR, -1)) \
-                    == trs.turn.turn_number,
-            user_turns)[0]
+        turn_xml = self._find_uturn(trs.turn.turn_number)
         if self.TRANSCRIPTIONS_ELEM is not None:
             trss_xml = turn_xml.find(self.TRANSCRIPTIONS_ELEM)
             if trss_xml is None:
@@ -513,6 +1394,8 @@ class XMLSession(object):
         else:
             insert_idx = trss_xml.index(trs_left_sib) + 1
         trss_xml.insert(insert_idx, trs_xml)
+        self._uturn_idx[trs.turn.turn_number].trss.append(trs_xml)
+        self.dirty = True
         return trs_xml
 
     def find_or_create_transcription(self, trs):
@@ -526,12 +1409,7 @@ class XMLSession(object):
 
         # Find the appropriate place for the annotation in the XML tree.
         dg_ann = sem_ann.dialogue_annotation
-        user_turns = self.sess_xml.findall(self.USERTURN_PATH)
-        turn_xml = filter(
-            lambda turn_xml: \
-                int(turn_xml.get(self.TURNNUMBER_ATTR)) \
-                    == sem_ann.turn.turn_number,
-            user_turns)[0]
+        turn_xml = self._find_uturn(sem_ann.turn.turn_number)
         if self.ANNOTATIONS_ELEM is not None:
             anns_xml = turn_xml.find(self.ANNOTATIONS_ELEM)
             if anns_xml is None:
@@ -572,6 +1450,7 @@ class XMLSession(object):
         else:
             insert_idx = anns_xml.index(ann_left_sib) + 1
         anns_xml.insert(insert_idx, ann_xml)
+        self.dirty = True
         return ann_xml
 
     def find_annotations(self):
@@ -591,6 +1470,7 @@ class XMLSession(object):
         if anns_el is None:
             anns_el = etree.Element(self.ANNOTATIONS_ELEM)
             anns_above.insert(anns_after_idx, anns_el)
+            self.dirty = True
         return anns_el
 
     def iter_annotations(self, **kwargs):
@@ -621,14 +1501,9 @@ class XMLSession(object):
 
         # Prepare for iteration.
         ann_id = annotation.get('id')
-        trs_subpath = ".{trss}/{trs}[@{ann_attr}='{ann}']".format(
-            trss=self.SLASH_TRANSCRIPTIONS_ELEM,
-            trs=self.TRANSCRIPTION_ELEM,
-            ann_attr="annotation",  # hard-wired in views.py, too
-            ann=ann_id)
 
         # Iterate user turns and yield their respective transcriptions.
-        for uturn_el in self.sess_xml.iterfind(self.USERTURN_PATH):
+        for uturn_el in self.userturn_xpath(self.sess_xml):
             try:
                 turn_number = int(uturn_el.get(self.TURNNUMBER_ATTR, -1))
             except TypeError:
@@ -637,7 +1512,7 @@ class XMLSession(object):
                 continue
             # Find transcriptions in this turn (assumably, there will be
             # one, but there may be none).
-            for trs in uturn_el.iterfind(trs_subpath):
+            for trs in self.trss_by_ann_xpath(uturn_el, ann=ann_id):
                 yield turn_number, trs
 
     def add_annotation(self, dg_ann, **more_attrs):
@@ -656,11 +1531,16 @@ class XMLSession(object):
             username = dg_ann.user.username
         else:
             username = ''
+        program_version = dg_ann.program_version
+        if not program_version:
+            # Imported here so that this module does not need Django.
+            from util import get_program_version
+            program_version = get_program_version()
         ann_el = etree.SubElement(
             anns_el,
             self.ANNOTATION_ELEM,
             id=str(dg_ann.pk),
-            program_version=dg_ann.program_version,
+            program_version=program_version,
             date_saved=self.format_datetime(dg_ann.date_saved),
             user=username)
         for name, val in more_attrs.iteritems():
@@ -674,6 +1554,10 @@ class XMLSession(object):
                        ('clear' if dg_ann.quality == 1 else 'noisy'))
         if dg_ann.notes:
             ann_el.text = dg_ann.notes
+        self.dirty = True
+        self._new_ann_ids.add(ann_el.get('id'))
+        if ann_el.get('worker_id') is not None:
+            self._new_worker_ids.add(ann_el.get('worker_id'))
 
     @classmethod
     def _turn_is_userturn(cls, turn_el):
@@ -684,8 +1568,7 @@ class XMLSession(object):
 
         # XXX This method was built in an ugly way, by putting together the
         # bodies of iter_uturns and iter_systurns.
-        turns = self.sess_xml.xpath(
-            '|'.join((self.USERTURN_PATH, self.SYSTURN_PATH)))
+        turns = self.turns_xpath(self.sess_xml)
         uturnnums_seen = set()
         for turn_abs_num, turn_xml in enumerate(turns, start=1):
             if self._turn_is_userturn(turn_xml):
@@ -736,7 +1619,7 @@ class XMLSession(object):
 
     def iter_uturns(self):
         turnnums_seen = set()
-        for uturn_xml in self.sess_xml.iterfind(self.USERTURN_PATH):
+        for uturn_xml in self.userturn_xpath(self.sess_xml):
             rec = uturn_xml.find(self.REC_SUBPATH)
             if rec is not None:
                 rec = rec.attrib[self.REC_FNAME_ATTR]
@@ -777,7 +1660,7 @@ class XMLSession(object):
         return text
 
     def iter_systurns(self):
-        for systurn_xml in self.sess_xml.iterfind(self.SYSTURN_PATH):
+        for systurn_xml in self.systurn_xpath(self.sess_xml):
             turn_number = int(systurn_xml.attrib[self.TURNNUMBER_ATTR])
             try:
                 text = systurn_xml.findtext(self.SYSTEXT_SUBPATH).strip()
@@ -857,11 +1740,11 @@ class XMLSession(object):
 
         # Set all the desired attributes.
         if 'worker_id' not in settings.LOGGED_JOB_DATA:
-            ann_el.set('worker_id', worker_id)
+            self.set_attr(ann_el, 'worker_id', worker_id)
         for json_key, att_name in settings.LOGGED_JOB_DATA:
             att_val = judgment.get(json_key, None)
             if att_val is not None:
-                ann_el.set(att_name, unicode(att_val))
+                self.set_attr(ann_el, att_name, unicode(att_val))
         return True
 
     def update_worker_stats(self, gold_stats):
@@ -880,6 +1763,6 @@ class XMLSession(object):
             worker_id = ann_el.get('worker_id', None)
             if worker_id in gold_stats:
                 ratio_str = '{0:.2f}'.format(gold_stats[worker_id])
-                ann_el.set('gold_ratio', ratio_str)
+                self.set_attr(ann_el, 'gold_ratio', ratio_str)
                 n_updated += 1
         return n_updated
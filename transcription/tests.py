@@ -5,7 +5,21 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import BaseHTTPServer
+import httplib
+import socket
+import SocketServer
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from transcription import dg_util
+from transcription.http_pool import ConnectionPool
+from transcription.models import (Dialogue, DialogueAnnotation, SystemTurn,
+    Transcription, UserTurn)
+from transcription.views import _create_turn_dicts
 
 
 class SimpleTest(TestCase):
@@ -14,3 +28,198 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TurnDictsQueriesTest(TestCase):
+    """
+    Checks that the number of queries needed to build turn dictionaries for
+    the transcription form does not grow with the number of turns.
+    """
+
+    def _create_dialogue(self, cid, n_turns):
+        dg = Dialogue.objects.create(cid=cid, dirname=cid, code='abcdef',
+                                     code_corr='abc', code_incorr='def')
+        SystemTurn.objects.bulk_create(
+            SystemTurn(dialogue=dg, turn_number=turn_number,
+                       turn_abs_number=2 * turn_number - 1,
+                       text='Prompt {num}.'.format(num=turn_number))
+            for turn_number in xrange(1, n_turns + 1))
+        UserTurn.objects.bulk_create(
+            UserTurn(dialogue=dg, turn_number=turn_number,
+                     turn_abs_number=2 * turn_number,
+                     wav_fname='{cid}/rec/{num}.wav'.format(cid=cid,
+                                                           num=turn_number),
+                     asr_hyp='hypothesis', slu_hyp='inform()')
+            for turn_number in xrange(1, n_turns + 1))
+        user = User.objects.create(username='user_{cid}'.format(cid=cid))
+        dg_ann = DialogueAnnotation.objects.create(dialogue=dg, user=user)
+        # Transcribe the first half of the user turns.
+        Transcription.objects.bulk_create(
+            Transcription(turn=uturn, dialogue_annotation=dg_ann,
+                          text='transcription {num}'.format(
+                              num=uturn.turn_number))
+            for uturn in UserTurn.objects.filter(
+                dialogue=dg, turn_number__lte=n_turns // 2))
+        return dg, dg_ann
+
+    def _assert_queries(self, n_turns):
+        dg, dg_ann = self._create_dialogue('turns{n}'.format(n=n_turns),
+                                           n_turns)
+        dg_util.invalidate_turn_layout(dg)
+        # Computing the turn layout, fetching transcriptions.
+        with self.assertNumQueries(3):
+            turns = _create_turn_dicts(dg, dg_ann)
+        self.assertEqual(len(turns), n_turns)
+        self.assertEqual(sum(1 for turn in turns if turn['initial_text']),
+                         n_turns // 2)
+        # The layout is cached now.
+        with self.assertNumQueries(1):
+            _create_turn_dicts(dg, dg_ann)
+        with self.assertNumQueries(0):
+            _create_turn_dicts(dg)
+
+    def test_few_turns(self):
+        self._assert_queries(4)
+
+    def test_many_turns(self):
+        self._assert_queries(60)
+
+
+class RecountAnnsTest(TestCase):
+    """Checks that annotation counts of dialogues get fixed."""
+
+    def test_recount(self):
+        dgs = [Dialogue.objects.create(cid='dg{num}'.format(num=num),
+                                       dirname='dg{num}'.format(num=num),
+                                       code='abcdef', code_corr='abc',
+                                       code_incorr='def')
+               for num in xrange(3)]
+        for dg in dgs[:2]:
+            DialogueAnnotation.objects.create(dialogue=dg)
+        # Bulk creation bypasses the signal handlers that keep the counts.
+        DialogueAnnotation.objects.bulk_create(
+            DialogueAnnotation(dialogue=dgs[1]) for _ in xrange(2))
+        Dialogue.objects.filter(pk=dgs[2].pk).update(n_annotations=5)
+
+        self.assertEqual(dg_util.recount_anns(), 2)
+        self.assertEqual(
+            dict(Dialogue.objects.values_list('cid', 'n_annotations')),
+            {'dg0': 1, 'dg1': 3, 'dg2': 0})
+        self.assertEqual(dg_util.recount_anns(), 0)
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with 200 OK, keeping the connection open.  Requests
+    to /slow take a while to answer, and after answering a request to /drop,
+    the connection is closed without telling the client.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.n_connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self):
+        with self.server.lock:
+            self.server.n_requests += 1
+            self.server.n_active += 1
+            self.server.max_active = max(self.server.max_active,
+                                         self.server.n_active)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            if self.path == '/slow':
+                time.sleep(.2)
+            body = 'OK'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if self.path == '/drop':
+                self.close_connection = 1
+        finally:
+            with self.server.lock:
+                self.server.n_active -= 1
+
+    do_GET = do_POST = _respond
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _StubHandler)
+        self.lock = threading.Lock()
+        self.n_connections = 0
+        self.n_requests = 0
+        self.n_active = 0
+        self.max_active = 0
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    """Tests the HTTP connection pool against a stub server on localhost."""
+
+    def setUp(self):
+        self.server = _StubServer()
+        self.url = 'http://127.0.0.1:{port}'.format(
+            port=self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': .05})
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        for _ in xrange(5):
+            status, _, _, body = pool.request('GET', self.url + '/')
+            self.assertEqual((status, body), (200, 'OK'))
+        self.assertEqual(self.server.n_connections, 1)
+        pool.close()
+
+    def test_per_host_limit(self):
+        pool = ConnectionPool(max_per_host=2)
+        threads = [threading.Thread(target=pool.request,
+                                    args=('GET', self.url + '/slow'))
+                   for _ in xrange(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.n_requests, 6)
+        self.assertEqual(self.server.max_active, 2)
+        self.assertEqual(self.server.n_connections, 2)
+        pool.close()
+
+    def test_idle_eviction(self):
+        pool = ConnectionPool(max_idle_secs=.1)
+        pool.request('GET', self.url + '/')
+        pool.request('GET', self.url + '/')
+        self.assertEqual(self.server.n_connections, 1)
+        time.sleep(.2)
+        pool.request('GET', self.url + '/')
+        self.assertEqual(self.server.n_connections, 2)
+        pool.close()
+
+    def test_retry_closed_connection(self):
+        pool = ConnectionPool()
+        pool.request('GET', self.url + '/drop')
+        # Idempotent requests are repeated on a new connection.
+        status, _, _, body = pool.request('GET', self.url + '/')
+        self.assertEqual((status, body), (200, 'OK'))
+        self.assertEqual(self.server.n_connections, 2)
+        pool.request('GET', self.url + '/drop')
+        n_requests = self.server.n_requests
+        # Other requests are not, as the server might have acted on them.
+        with self.assertRaises((httplib.HTTPException, socket.error)):
+            pool.request('POST', self.url + '/', 'data')
+        self.assertEqual(self.server.n_requests, n_requests)
+        pool.close()
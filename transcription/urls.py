@@ -26,6 +26,14 @@ pattern_args = ['',
                     'transcription.views.import_dialogues',
                     name="import_dialogues"),
 
+                url('^import/(?P<job_id>\d+)$',
+                    'transcription.views.import_job',
+                    name="import_job"),
+
+                url('^import/(?P<job_id>\d+)/progress$',
+                    'transcription.views.import_progress',
+                    name="import_progress"),
+
                 url('^delete$',
                     'transcription.views.delete_list',
                     name="delete_dialogues"),
@@ -5,7 +5,12 @@ from __future__ import unicode_literals
 
 from datetime import datetime
 from functools import wraps
+import os
 import os.path
+import shutil
+from subprocess import CalledProcessError, check_output
+from threading import Lock
+import time
 
 from django.core.mail import mail_admins
 from django.shortcuts import render
@@ -14,6 +19,11 @@ from django.core.urlresolvers import reverse, NoReverseMatch
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import settings
 
 
@@ -79,6 +89,94 @@ def get_log_path(dirname):
     return log_path
 
 
+# Ways of making a file available in another directory, in the order they
+# are tried by `link_or_copy'.
+LINK_STRATEGIES = ('hardlink', 'reflink', 'symlink', 'copy')
+# The ioctl request that clones a file on a copy-on-write filesystem (Linux).
+_FICLONE = 0x40049409
+
+
+def _reflink(src, tgt):
+    try:
+        with open(src, 'rb') as src_file, open(tgt, 'wb') as tgt_file:
+            fcntl.ioctl(tgt_file.fileno(), _FICLONE, src_file.fileno())
+    except:
+        if os.path.lexists(tgt):
+            os.remove(tgt)
+        raise
+    shutil.copystat(src, tgt)
+
+
+def link_or_copy(src, tgt_dir):
+    """
+    Makes a file available in a directory, preferably without copying its
+    data.  A hard link, a reflink (a copy-on-write clone) and a symbolic
+    link are tried, in this order, and the file is copied if none of them
+    can be made.
+
+    Arguments:
+        src -- path towards the file
+        tgt_dir -- the directory where the file should appear, under the same
+                   basename
+
+    Returns the name of the strategy used (one of LINK_STRATEGIES).
+
+    """
+    tgt = os.path.join(tgt_dir, os.path.basename(src))
+    # Never write through an existing link, it could change the source file.
+    if os.path.lexists(tgt):
+        os.remove(tgt)
+    try:
+        os.link(src, tgt)
+        return 'hardlink'
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            _reflink(src, tgt)
+            return 'reflink'
+        except (IOError, OSError):
+            pass
+    try:
+        os.symlink(os.path.abspath(src), tgt)
+        return 'symlink'
+    except OSError:
+        pass
+    shutil.copy2(src, tgt)
+    return 'copy'
+
+
+# The program version resolved last, and when it was resolved.
+_program_version = None
+_program_version_time = None
+_program_version_lock = Lock()
+
+
+def get_program_version():
+    """
+    Returns the version of this program, i.e. the ID of the git commit checked
+    out in PROJECT_DIR.  The version is resolved once per process, and
+    resolved again only if PROGRAM_VERSION_REFRESH seconds have passed since
+    (if that setting is not None).  If the version cannot be determined, an
+    empty string is returned.
+
+    """
+    global _program_version, _program_version_time
+    refresh = settings.PROGRAM_VERSION_REFRESH
+    with _program_version_lock:
+        if (_program_version is None or
+                (refresh is not None and
+                 time.time() - _program_version_time >= refresh)):
+            try:
+                _program_version = unicode(check_output(
+                    ["git", "rev-parse", "HEAD"],
+                    cwd=settings.PROJECT_DIR).rstrip('\n'))
+            except (CalledProcessError, OSError):
+                _program_version = ''
+            _program_version_time = time.time()
+        return _program_version
+
+
 def group_by(objects, attrs):
     """Groups `objects' by the values of their attributes `attrs'.
 
@@ -5,43 +5,47 @@ from __future__ import unicode_literals
 
 import codecs
 from collections import namedtuple
-from datetime import datetime
-import hashlib
 from itertools import chain
+import json
+import multiprocessing
 import os
 import os.path
 import random
 import shutil
-from subprocess import check_output
 
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.contrib.auth.models import User
-from django.db import DatabaseError
-from django.db.models import Count
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import F
 from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.views.decorators.csrf import csrf_exempt
 
 import crowdflower
-from crowdflower import (collect_judgments, create_job, delete_job,
-    fire_gold_hooks, price_class_handler, process_worklog, JsonDialogueUpload,
-    record_worker)
+from crowdflower import (cf_executor, collect_judgments,
+    collect_judgments_for_jobs, create_job, delete_job, fire_gold_hooks,
+    price_class_handler, process_worklog, record_worker)
+import dg_import
 import dg_util
 import session_xml
-from session_xml import (FileNotFoundError, XMLSession, UserTurnAbs_nt)
+from session_xml import XMLSession
 import settings
 from tr_normalisation import trss_match
 from transcription.forms import DateRangeForm, FileListForm, TranscriptionForm
 if settings.USE_CF:
     from transcription.forms import WorkLogsForm, CreateJobForm, DeleteJobForm
 from transcription.models import (Transcription, DialogueAnnotation,
-    Dialogue, UserTurn, SystemTurn, SemanticAnnotation)
-from util import das_match, get_log_path, group_by, catch_locked_database
+    Dialogue, ImportJob, ImportJobItem, UserTurn, SystemTurn,
+    SemanticAnnotation)
+from util import (das_match, get_log_path, get_program_version, group_by,
+    catch_locked_database)
 
 # Initialisation.
 random.seed()
+# Resolve the program version when the process starts, not on a request.
+get_program_version()
 
 # Some auxiliary classes.
 dgstats_nt = namedtuple('DialogueStats', ['list_filename', 'n_annotated_in',
@@ -49,212 +53,31 @@ dgstats_nt = namedtuple('DialogueStats', ['list_filename', 'n_annotated_in',
                                           'n_all'])
 open_annion_nt = namedtuple('OpenAnnotation', ['ann_str', 'link'])
 
-
-# Auxiliary functions.
-def _hash(s):
-    return hashlib.sha1(s).hexdigest()
+# How many times to try reserving a dialogue for an annotator before giving
+# up (each failed try means another annotator took the last free slot of the
+# dialogue in the meantime).
+_LEASE_ATTEMPTS = 10
 
 
+# Auxiliary functions.
 def finished(request):
     return render(request, "trs/finished.html")
 
 
-def _gen_codes():
-    """
-    Generates a random code for a dialogue, to be used in validation of CF
-    workers' input.
-    """
-
-    code = ''.join(random.choice('0123456789')
-                   for _ in xrange(settings.CODE_LENGTH))
-    code_corr = ''.join(random.choice('0123456789')
-                        for _ in xrange(settings.CODE_LENGTH_EXT))
-    code_incorr = code_corr
-    while code_incorr == code_corr:
-        code_incorr = ''.join(random.choice('0123456789')
-                              for _ in xrange(settings.CODE_LENGTH_EXT))
-    return (code, code_corr, code_incorr)
-
-
 def _rand_alnum(length=5):
     alnum = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
     return ''.join(random.choice(alnum) for _ in xrange(length))
 
 
-def _read_dialogue_turns(dg_data, dirname, with_trss=False, only_order=False):
-    """
-    Reads system and user turns from an XML session file and saves it
-    to the DB.  This function should be called after the dialogue in question
-    has been copied into the target directory (one called after its CID).
-
-    Arguments:
-        dg_data -- the Django object for the dialogue that should be saved
-        dirname -- path towards the directory where related WAV files should be
-                   looked for
-        with_trss -- should any annotations and transcriptions be read too?
-            (default: False)
-        only_order -- used to fix the order of turns using the `turn_abs_num'
-            datum
-
-    """
-
-    if only_order:
-        sys_turns = SystemTurn.objects.filter(dialogue=dg_data)
-        user_turns = UserTurn.objects.filter(dialogue=dg_data)
-
-        def _get_uturn(uturn_nt):
-            uturn = user_turns.get(turn_number=uturn_nt.turn_number)
-            uturn.turn_abs_number = uturn_nt.turn_abs_number
-            return uturn
-
-        def _get_systurn(systurn_nt):
-            systurn = sys_turns.get(turn_number=systurn_nt.turn_number)
-            systurn.turn_abs_number = systurn_nt.turn_abs_number
-            return systurn
-    else:
-
-        def _get_uturn(uturn_nt):
-            return UserTurn(dialogue=dg_data,
-                            turn_number=turnnum,
-                            turn_abs_number=uturn_nt.turn_abs_number,
-                            wav_fname=wav_path,
-                            asr_hyp=uturn_nt.asr_hyp,
-                            slu_hyp=uturn_nt.slu_hyp)
-
-        def _get_systurn(systurn_nt):
-            return SystemTurn(dialogue=dg_data,
-                              turn_number=systurn_nt.turn_number,
-                              turn_abs_number=systurn_nt.turn_abs_number,
-                              text=systurn_nt.text)
-
-    with XMLSession(dg_data.cid) as session:
-
-        # Save all the turns as database objects.
-        uturns = list()
-        for turn_nt in session.iter_turns():
-            # Take special care to not overwrite user turns with other user
-            # turns with a duplicate turn number (known fault of some XML
-            # logs).
-            if isinstance(turn_nt, UserTurnAbs_nt):
-                if turn_nt.wav_fname is not None:
-                    turnnum = turn_nt.turn_number
-                    # Do not override turns saved earlier.
-                    if (turnnum < len(uturns) and
-                            uturns[turnnum] is not None):
-                        continue
-
-                    # Create the user turn object.
-                    wav_path = os.path.join(dirname, turn_nt.wav_fname)
-                    uturn = _get_uturn(turn_nt)
-
-                    # Prepare the `uturns' list for storing the new user
-                    # turn.
-                    while turnnum > len(uturns):
-                        uturns.append(None)
-
-                    # Save the user turn object.
-                    uturns.append(uturn)
-                    assert (uturns[turnnum] == uturn)
-                    uturn.save()
-            else:
-                _get_systurn(turn_nt).save()
-
-        if only_order:
-            return
-
-        # If transcriptions should be read and saved as well,
-        if with_trss:
-            dummy_user = None
-
-            # Iterate over all dialogue annotations.
-            for ann_el in session.iter_annotations():
-                # Retrieve all properties of the dialogue annotation
-                # object.
-                notes = ('' if ann_el.text is None
-                         else ann_el.text.strip())
-                program_version = ann_el.get('program_version')
-                ann_users = User.objects.filter(
-                    username=ann_el.get('user'))
-                if ann_users.exists():
-                    ann_user = ann_users[0]
-                else:
-                    ann_user = dummy_user
-
-                ann_props = {'dialogue': dg_data,
-                             'notes': notes,
-                             'user': ann_user,
-                             'program_version': program_version}
-
-                if 'accent' in settings.EXTRA_QUESTIONS:
-                    accent_str = ann_el.get('accent')
-                    accent = ("" if accent_str == 'native' else accent_str)
-                    ann_props['accent'] = accent
-                if 'offensive' in settings.EXTRA_QUESTIONS:
-                    offensive = (ann_el.get("offensive") == "True")
-                    ann_props['offensive'] = offensive
-                if 'quality' in settings.EXTRA_QUESTIONS:
-                    quality = (DialogueAnnotation.QUALITY_CLEAR
-                               if ann_el.get('quality') == 'clear'
-                               else DialogueAnnotation.QUALITY_NOISY)
-                    ann_props['quality'] = quality
-
-                date_saved = session.parse_datetime(ann_el.get('date_saved'))
-
-                # Check whether this object has been imported already.
-                if not DialogueAnnotation.objects.filter(
-                        date_saved=date_saved, **ann_props):
-                    # Save the dialogue annotation.
-                    dg_ann = DialogueAnnotation(**ann_props)
-                    dg_ann.save()
-
-                    # Find all transcriptions that belong to this dialogue
-                    # annotation and save them as database objects.
-                    for turnnum, trs_el in session.iter_transcriptions(
-                            ann_el):
-                        i_gold = (trs_el.get('is_gold') != '0')
-                        b_gold = (trs_el.get('breaks_gold') != '0')
-                        sb_gold = (trs_el.get('some_breaks_gold') != '0')
-                        Transcription(text=trs_el.text,
-                                      turn=uturns[turnnum],
-                                      dialogue_annotation=dg_ann,
-                                      is_gold=i_gold,
-                                      breaks_gold=b_gold,
-                                      some_breaks_gold=sb_gold).save()
-
-
-# TODO Move elsewhere (dg_util? models?).
-def _create_turn_dicts(dialogue, dg_ann=None):
-    """An auxiliary function for gathering important data about dialogue turns
-    for use in the transcription form.
-
-    Returns a list of dictionaries, one per turn, to be used with the
-    `transcribe.html' template.  The turns are numbered (key `turn_number') but
-    this numbering is only for purposes of the template. It does NOT correspond
-    to the turn database objects' turn_number attribute.
-
-    Arguments:
-        dialogue ... the Dialogue object for whose turns to build the
-                     dictionary
-        dg_ann   ... a DialogueAnnotation object to use to fill in initial
-                     values (default: None)
-
-    """
+def _compute_turn_layout(dialogue):
+    """Computes the turn layout of a dialogue (see `_get_turn_layout')."""
 
     _using_slu = 'slu' in settings.TASKS
 
-    transcriptions = None
-    last_transcribed = -1
-    if dg_ann is not None:
-        transcriptions = (Transcription.objects
-                          .filter(dialogue_annotation=dg_ann))
-        if transcriptions:
-            last_transcribed = max(trs.turn.turn_number
-                                   for trs in transcriptions)
-
-    uturns = UserTurn.objects.filter(dialogue=dialogue)
-    systurns = SystemTurn.objects.filter(dialogue=dialogue)
-    max_turn_num = max(max(uturn.turn_abs_number for uturn in uturns) if uturns else 0,
-                       max(sturn.turn_abs_number for sturn in systurns) if systurns else 0)
+    uturns = list(UserTurn.objects.filter(dialogue=dialogue))
+    systurns = list(SystemTurn.objects.filter(dialogue=dialogue))
+    max_turn_num = max([0] + [turn.turn_abs_number
+                              for turn in uturns + systurns])
 
     # Transform data from DialogueTurn objects into dicts.
     turns = [dict() for _ in xrange(max_turn_num)]
@@ -263,22 +86,12 @@ def _create_turn_dicts(dialogue, dg_ann=None):
         if systurn.text:
             turns[systurn.turn_abs_number - 1].update(prompt=systurn.text,
                                                       has_rec=False)
-    trss_uptoprev = bool(transcriptions)
-    trss_uptothis = bool(transcriptions)
+    layout_uturns = list()
     for uturn in uturns:
         # Find the relevant part of the WAV file path.
         seclast_slash = uturn.wav_fname.rfind(
             os.sep, 0, uturn.wav_fname.rfind(os.sep))
         wav_fname_rest = uturn.wav_fname[seclast_slash:]
-        # Find if an existing transcription is available for this turn.
-        initial_text = ''
-        if transcriptions:
-            turn_trss = transcriptions.filter(turn=uturn)
-            if turn_trss:
-                assert len(turn_trss) == 1
-                initial_text = turn_trss[0].text
-            if uturn.turn_number > last_transcribed:
-                trss_uptothis = False
         # SLU
         if _using_slu:
             # Get the DAIs and their textual representation for the SLU
@@ -310,66 +123,172 @@ def _create_turn_dicts(dialogue, dg_ann=None):
         turn_dict = turns[prev_turn_idx]
         turn_dict.update(rec=wav_fname_rest,
                          has_rec=True,
-                         uturn_number=uturn.turn_number,
-                         initial_text=initial_text,
-                         unfold=trss_uptoprev)
+                         uturn_number=uturn.turn_number)
         if _using_slu:
             turn_dict['dais_txts'] = dais_txts
-        trss_uptoprev = trss_uptothis
+        layout_uturns.append((prev_turn_idx, uturn.pk, uturn.turn_number))
 
     # Number the turns.
+    new_idxs = dict()  # :: {index to `turns' -> index to non-empty turns}
+    for turn_idx, turn in enumerate(turns):
+        if turn:
+            new_idxs[turn_idx] = len(new_idxs)
     turns = filter(None, turns)
     for turn_number, turn in enumerate(turns, start=1):
         turn['turn_number'] = turn_number
         turn['dbl_turn_num'] = 2 * turn_number
+    layout_uturns = [(new_idxs[turn_idx], uturn_id, turn_number)
+                     for turn_idx, uturn_id, turn_number in layout_uturns]
+    return turns, layout_uturns
+
+
+def _get_turn_layout(dialogue):
+    """
+    Returns the layout of turns of a dialogue in the transcription form.  The
+    turns do not change after the dialogue has been imported, so the layout
+    is computed only once and then kept in the cache.
+
+    Returns a tuple (turns, uturns) where `turns' is a list of turn
+    dictionaries (see `_create_turn_dicts') without any values specific to
+    a dialogue annotation, and `uturns' is a list of tuples (index to `turns',
+    user turn ID, user turn number), one for each user turn in the order the
+    user turns were merged into `turns'.
+
+    Arguments:
+        dialogue -- the Dialogue object whose turns to lay out
+
+    """
+    key = dg_util.turn_layout_key(dialogue)
+    layout = cache.get(key)
+    if layout is None:
+        layout = _compute_turn_layout(dialogue)
+        cache.set(key, layout)
+    return layout
+
+
+# TODO Move elsewhere (dg_util? models?).
+def _create_turn_dicts(dialogue, dg_ann=None):
+    """An auxiliary function for gathering important data about dialogue turns
+    for use in the transcription form.
+
+    Returns a list of dictionaries, one per turn, to be used with the
+    `transcribe.html' template.  The turns are numbered (key `turn_number') but
+    this numbering is only for purposes of the template. It does NOT correspond
+    to the turn database objects' turn_number attribute.
+
+    Arguments:
+        dialogue ... the Dialogue object for whose turns to build the
+                     dictionary
+        dg_ann   ... a DialogueAnnotation object to use to fill in initial
+                     values (default: None)
+
+    """
+
+    # Fetch the transcriptions from the DB at once.
+    transcriptions = dict()  # :: {user turn ID -> transcription}
+    last_transcribed = -1
+    if dg_ann is not None:
+        for trs in (Transcription.objects.filter(dialogue_annotation=dg_ann)
+                    .select_related('turn')):
+            assert trs.turn_id not in transcriptions
+            transcriptions[trs.turn_id] = trs
+        if transcriptions:
+            last_transcribed = max(trs.turn.turn_number
+                                   for trs in transcriptions.itervalues())
+
+    # Fill in values specific to the dialogue annotation into a copy of the
+    # turn layout.
+    layout_turns, layout_uturns = _get_turn_layout(dialogue)
+    turns = [dict(turn) for turn in layout_turns]
+    trss_uptoprev = bool(transcriptions)
+    trss_uptothis = bool(transcriptions)
+    for turn_idx, uturn_id, turn_number in layout_uturns:
+        # Find if an existing transcription is available for this turn.
+        initial_text = ''
+        if transcriptions:
+            if uturn_id in transcriptions:
+                initial_text = transcriptions[uturn_id].text
+            if turn_number > last_transcribed:
+                trss_uptothis = False
+        turns[turn_idx].update(initial_text=initial_text,
+                               unfold=trss_uptoprev)
+        trss_uptoprev = trss_uptothis
+
     # Return.
     return turns
 
 
-def _delete_old_anns():
-    sessions_earliest_start = datetime.now() - settings.SESSION_EXPIRED
-    old_anns = DialogueAnnotation.objects.filter(
-        finished=False,
-        date_saved__lte=sessions_earliest_start)
-    old_anns.delete()
+def _find_free_cid(user=None):
+    """
+    Finds a dialogue that is still free to be annotated by `user`.
 
+    Returns the CID of the dialogue, or None if there is none left.  Dialogues
+    with fewer annotations are preferred.
 
-def _find_free_cids(user=None):
-    """
-    Finds dialogues that are still free to be annotated by `user`.
     """
-    # Count which dialogues do not have the full required number of
-    # transcriptions.
-    if settings.MAX_ANNOTATIONS_PER_INPUT is None:
-        cids_done = set()
-    else:
-        _max_annions = settings.MAX_ANNOTATIONS_PER_INPUT  # shorthand
-        dg_ann_counts = (DialogueAnnotation.objects
-                         .annotate(Count('dialogue'))
-                         .filter(dialogue__count__gte=_max_annions))
-        cids_done = set(ann.dialogue.cid for ann in dg_ann_counts)
+    free_dgs = Dialogue.objects.order_by('n_annotations')
+    # Exclude dialogues that already have the full required number of
+    # annotations.
+    if settings.MAX_ANNOTATIONS_PER_INPUT is not None:
+        free_dgs = free_dgs.filter(
+            n_annotations__lt=settings.MAX_ANNOTATIONS_PER_INPUT)
 
     # If being annotated by this user does not imply the dialogue was already
-    # included in the above query results,
+    # excluded by the above condition,
     filter_out_by_user = (user is not None and
                           (settings.MAX_ANNOTATIONS_PER_INPUT is None or
                            settings.MAX_ANNOTATIONS_PER_INPUT > 1))
     if filter_out_by_user:
+        # Exclude dialogues annotated by this user explicitly (using
+        # a subquery).
         if 'asr' in settings.TASKS:
-            # Exclude dialogues annotated by this user explicitly.
-            trss_done = Transcription.objects.filter(
+            dgs_done = Transcription.objects.filter(
                 dialogue_annotation__user=user)
-            cids_done.update(trs.dialogue_annotation.dialogue.cid
-                             for trs in trss_done)
         elif 'slu' in settings.TASKS:
-            # Exclude dialogues annotated by this user explicitly.
-            anns_done = SemanticAnnotation.objects.filter(
+            dgs_done = SemanticAnnotation.objects.filter(
                 dialogue_annotation__user=user)
-            cids_done.update(sem_ann.dialogue_annotation.dialogue.cid
-                             for sem_ann in anns_done)
+        else:
+            dgs_done = None
+        if dgs_done is not None:
+            free_dgs = free_dgs.exclude(cid__in=dgs_done.values(
+                'dialogue_annotation__dialogue'))
+
+    free_cids = list(free_dgs.values_list('cid', flat=True)[:1])
+    return free_cids[0] if free_cids else None
+
+
+def _lease_dialogue(user):
+    """
+    Reserves a free dialogue for `user' by creating an unfinished dialogue
+    annotation for it.  The reservation is safe against concurrent requests:
+    a slot is claimed by an update of the dialogue's annotation count that
+    only succeeds if the count is still below MAX_ANNOTATIONS_PER_INPUT.  The
+    reservation expires after SESSION_EXPIRED, when the unfinished annotation
+    gets deleted.
 
-    cids_todo = set(Dialogue.objects.values_list('cid', flat=True)) - cids_done
-    return cids_todo
+    Returns the new DialogueAnnotation, or None if there is no free dialogue
+    left.
+
+    """
+    _max_annions = settings.MAX_ANNOTATIONS_PER_INPUT  # shorthand
+    for _ in xrange(_LEASE_ATTEMPTS):
+        cid = _find_free_cid(user)
+        if cid is None:
+            return None
+        with transaction.commit_on_success():
+            # Claim a slot, unless someone else has taken the last one since.
+            if _max_annions is not None:
+                n_claimed = (Dialogue.objects
+                             .filter(cid=cid, n_annotations__lt=_max_annions)
+                             .update(n_annotations=F('n_annotations') + 1))
+                if not n_claimed:
+                    continue
+            dg_ann = DialogueAnnotation(user=user, dialogue_id=cid,
+                                        finished=False)
+            dg_ann.counted = _max_annions is not None
+            dg_ann.save()
+        return dg_ann
+    return None
 
 
 def _find_open_anns(user):
@@ -385,7 +304,6 @@ def _get_annotation_link(dg_ann):
 @login_required
 @catch_locked_database
 def open_annions(request):
-    _delete_old_anns()
     open_annions = _find_open_anns(request.user)
     anns_sorted = sorted(open_annions, key=lambda ann: ann.date_saved)
     anns_dicts = [open_annion_nt(ann_str=unicode(ann),
@@ -470,9 +388,7 @@ def transcribe(request):
                 dg_ann = DialogueAnnotation()
                 dg_ann.dialogue = dg_data
 
-            dg_ann.program_version = unicode(check_output(
-                ["git", "rev-parse", "HEAD"],
-                cwd=settings.PROJECT_DIR).rstrip('\n'))
+            dg_ann.program_version = get_program_version()
             if 'quality' in settings.EXTRA_QUESTIONS:
                 dg_ann.quality = (DialogueAnnotation.QUALITY_CLEAR if
                                   request.POST['quality'] == 'clear'
@@ -488,10 +404,14 @@ def transcribe(request):
                 dg_ann.user = dummy_user
             else:
                 dg_ann.user = request.user
-            dg_ann.save()
 
-            # Read the XML session file.
-            with XMLSession(cid) as session:
+            # Read the XML session file.  Saving transcriptions below updates
+            # the same file, so batch all the changes into a single write,
+            # done only once the database changes have been committed.
+            with session_xml.batched_sessions(), \
+                    transaction.commit_on_success(), \
+                    XMLSession(cid) as session:
+                dg_ann.save()
 
                 if not uturns:
                     mismatch = False
@@ -731,19 +651,15 @@ def transcribe(request):
             # If there is no open annotation for this user, find a dialogue
             # that is free to annotate.
             else:
-                # Start by deleting old open transcriptions.
-                _delete_old_anns()
-
-                # Find free dialogues for this user.
-                cids_todo = _find_free_cids(request.user)
+                # Reserve a free dialogue for this user.
+                cur_annion = _lease_dialogue(request.user)
 
                 # Serve him the next free dialogue if there is one, else tell
                 # him he is finished.
-                try:
-                    cid = cids_todo.pop()
-                except KeyError:
+                if cur_annion is None:
                     return HttpResponseRedirect("finished")
-                dg_data = Dialogue.objects.get(cid=cid)
+                dg_data = cur_annion.dialogue
+                cid = dg_data.cid
 
         else:  # Known user, CID specified => dg_data has been initialized
             # Find if there is a suitable open dialogue annotation.
@@ -754,7 +670,7 @@ def transcribe(request):
         # Create or refresh the current DialogueAnnotation.
         if open_annions:
             open_annions.update(finished=False)
-        else:
+        elif cur_annion is None:
             cur_annion = DialogueAnnotation(user=request.user,
                                             dialogue=dg_data,
                                             finished=False)
@@ -815,22 +731,30 @@ def home(request):
     return render(request, "trs/home.html")
 
 
+def _get_n_workers(request, name, default):
+    try:
+        return max(1, int(request.GET[name]))
+    except (KeyError, ValueError):
+        return default
+
+
 @login_required
 @user_passes_test(lambda u: u.is_staff)
 def import_dialogues(request):
+    """
+    Queues an import job for dialogues from a file list.  The job is run by
+    the `run_import_jobs' management command (see `dg_import').
+    """
+    n_parse_procs = (settings.IMPORT_PARSE_PROCESSES
+                     or multiprocessing.cpu_count())
+    n_copy_threads = settings.IMPORT_COPY_THREADS
+
     # Check whether the form is yet to be served.
     if not request.GET:
-        return render(request, "trs/import.html")
-
-    # Initialisation.
-    session_missing = []
-    session_empty = []
-    copy_failed = []
-    save_failed = []
-    save_price_failed = []
-    dg_existed = []
-    dg_updated = []
-    count = 0   # number of successfully imported dialogues
+        context = {'parse_procs': n_parse_procs,
+                   'copy_threads': n_copy_threads,
+                   'jobs': ImportJob.objects.order_by('-date_created')[:10]}
+        return render(request, "trs/import.html", context)
 
     # Read variables from the form.
     csv_fname = request.GET.get('csv_fname', '')
@@ -840,157 +764,49 @@ def import_dialogues(request):
         if not os.path.isabs(csv_fname):
             csv_fname = os.path.join(settings.CONVERSATION_DIR, csv_fname)
 
-    dirlist_fname = os.path.abspath(request.GET['list_fname'])
-    with_trss = request.GET.get('with_trss', False) == 'on'
-    only_order = request.GET.get('only_order', False) == 'on'
-    ignore_exdirs = request.GET.get('ignore_exdirs', False) == 'on'
-    upload_to_cf = settings.USE_CF and request.GET.get('upload', False) == 'on'
-
-    # Make sure the output file's directory exists.
-    csv_dirname = os.path.dirname(csv_fname)
-    if not os.path.isdir(csv_dirname):
-        os.makedirs(csv_dirname)
-
-    # Do the import.
-    with open(dirlist_fname, 'r') as dirlist_file, \
-            open(csv_fname, 'w') as csv_file:
-        # Prepare the JSON upload data, and the CSV header.
-        if upload_to_cf:
-            json_data = JsonDialogueUpload()
-        csv_file.write('cid,code,code_gold\n')
-        # Process the dialogue files.
-        for line in dirlist_file:
-            src_fname = line.rstrip().rstrip(os.sep)
-            dirname = os.path.basename(src_fname)
-
-            # Check that that directory contains the required session XML file.
-            try:
-                sess_fname = XMLSession.find_session_fname(src_fname)
-            except FileNotFoundError:
-                session_missing.append(src_fname)
-                continue
-            # Check that there are enough user turns in the session.
-            # As a by-product, collect names of audio files referred to from
-            # the session.
-            rec_fnames = list()
-            with XMLSession(fname=sess_fname, mode='r') as session:
-                n_empty_turns = 0
-                for uturn_num, uturn_nt in enumerate(session.iter_uturns(),
-                                                     start=1):
-                    if not uturn_nt.wav_fname:
-                        n_empty_turns += 1
-                    else:
-                        rec_fnames.append(uturn_nt.wav_fname)
-                if uturn_num - n_empty_turns < settings.MIN_TURNS:
-                    session_empty.append(src_fname)
-                    continue
+    job = ImportJob(
+        list_filename=os.path.abspath(request.GET['list_fname']),
+        csv_fname=csv_fname,
+        with_trss=request.GET.get('with_trss', False) == 'on',
+        only_order=request.GET.get('only_order', False) == 'on',
+        ignore_exdirs=request.GET.get('ignore_exdirs', False) == 'on',
+        upload=settings.USE_CF and request.GET.get('upload', False) == 'on',
+        link_audio=request.GET.get('link_audio', False) == 'on',
+        parse_procs=_get_n_workers(request, 'parse_procs', n_parse_procs),
+        copy_threads=_get_n_workers(request, 'copy_threads', n_copy_threads))
+    job.save()
+    return HttpResponseRedirect(reverse('import_job', args=(job.pk, )))
+
+
+def _import_progress(job):
+    return {'status': job.get_status_display(),
+            'finished': job.status in (ImportJob.STATUS_DONE,
+                                       ImportJob.STATUS_FAILED),
+            'n_dialogues': job.n_dialogues,
+            'n_done': (ImportJobItem.objects.filter(job=job)
+                       .exclude(outcome='copying').count()),
+            'error': job.error}
 
-            # Generate CID.
-            cid = _hash(dirname)
-            # Check that this CID does not collide with a hash for another
-            # dirname.  This is a crude implementation of hashing with
-            # replacement.
-            same_cid_dgs = Dialogue.objects.filter(cid=cid)
-            salt = -1
-            while same_cid_dgs and same_cid_dgs[0].dirname != dirname:
-                salt += 1
-                cid = _hash(dirname + str(salt))
-                same_cid_dgs = Dialogue.objects.filter(cid=cid)
-
-            # Copy the dialogue files.
-            tgt_fname = os.path.join(settings.CONVERSATION_DIR, cid)
-            try:
-                # Make the target directory.
-                os.mkdir(tgt_fname)
-                # Copy the session XML log.
-                shutil.copy2(sess_fname, tgt_fname)
-                # Copy all the audio needed.
-                for rec_fname in rec_fnames:
-                    rec_path = os.path.join(src_fname, rec_fname)
-                    shutil.copy2(rec_path, tgt_fname)
-                # shutil.copytree(src_fname, tgt_fname)
-            except:
-                if not ignore_exdirs:
-                    copy_failed.append(src_fname)
-                    continue
 
-            # Create an object for the dialogue and save it in the DB, unless
-            # it has been there already.
-            if same_cid_dgs:
-                # XXX If only updating the absolute turn numbers,
-                if only_order:
-                    # Do update the order.
-                    dg_data = Dialogue.objects.get(cid=cid)
-                    _read_dialogue_turns(dg_data, tgt_fname, with_trss,
-                                         only_order=True)
-                    dg_updated.append(dirname)
-                else:
-                    dg_existed.append(dirname)
-
-                continue
-            # Generate codes and other defining attributes of the dialogue.
-            dg_codes = _gen_codes()
-            dg_data = Dialogue(cid=cid,
-                               code=dg_codes[0],
-                               code_corr=dg_codes[1],
-                               code_incorr=dg_codes[2],
-                               dirname=dirname,
-                               list_filename=dirlist_fname)
-            try:
-                dg_data.save()
-            except:
-                save_failed.append((dirname, cid))
-                continue
-            # Read the dialogue turns.
-            _read_dialogue_turns(dg_data, tgt_fname, with_trss,
-                                 only_order=False)
-            # Compute the dialogue price.
-            dg_util.update_price(dg_data)
-            # Update the dialogue in the DB.
-            try:
-                dg_data.save()
-            except:
-                save_price_failed.append((dirname, cid))
-                continue
-
-            # Add a record to the CSV for CrowdFlower. (kept for extra safety)
-            code_gold = dg_codes[0] + dg_codes[1]
-            csv_file.write('{cid},{code},{gold}\n'
-                           .format(cid=cid, code=dg_codes[0], gold=code_gold))
-            # Add a record to the JSON for CrowdFlower.
-            if upload_to_cf:
-                json_data.add(dg_data)
-
-            count += 1
-
-    if upload_to_cf:
-        cf_ret, cf_msg = json_data.upload()
-        if cf_ret is False:
-            cf_error = cf_msg
-        else:
-            cf_error = None
-    # Render the response.
-    context = dict()
-    context['MIN_TURNS'] = settings.MIN_TURNS
-    context['session_missing'] = session_missing
-    context['session_empty'] = session_empty
-    context['copy_failed'] = copy_failed
-    context['save_failed'] = save_failed
-    context['save_price_failed'] = save_price_failed
-    context['dg_existed'] = dg_existed
-    context['dg_updated'] = dg_updated
-    if upload_to_cf:
-        context['cf_upload'] = True
-        context['cf_error'] = cf_error
-    else:
-        context['cf_upload'] = False
-    context['csv_fname'] = csv_fname
-    context['count'] = count
-    context['n_failed'] = (len(session_missing) + len(session_empty)
-                           + len(copy_failed) + len(save_failed)
-                           + len(save_price_failed) + len(dg_existed)
-                           + len(dg_updated))
-    return render(request, "trs/imported.html", context)
+@login_required
+@user_passes_test(lambda u: u.is_staff)
+def import_job(request, job_id):
+    """Shows progress of an import job, or its report once it is done."""
+    job = get_object_or_404(ImportJob, pk=job_id)
+    if job.status == ImportJob.STATUS_DONE:
+        return render(request, "trs/imported.html",
+                      dg_import.import_report(job))
+    context = {'job': job, 'progress': _import_progress(job)}
+    return render(request, "trs/import-job.html", context)
+
+
+@login_required
+@user_passes_test(lambda u: u.is_staff)
+def import_progress(request, job_id):
+    """Reports progress of an import job in JSON."""
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return HttpResponse(json.dumps(_import_progress(job)),
+                        content_type='application/json')
 
 
 @login_required
@@ -1065,6 +881,9 @@ def delete_list(request):
             for dg in dgs_todelete:
                 dg_path = os.path.join(settings.CONVERSATION_DIR, dg.cid)
                 try:
+                    # Audio files may be links to the original recordings
+                    # (see `import_dialogues').  `rmtree' only removes the
+                    # links, never what they point to.
                     shutil.rmtree(dg_path)
                 except:
                     remaining_dirs.append(dg_path)
@@ -1122,8 +941,6 @@ def temp_test(request):
 
 
 if settings.USE_CF:
-    import json
-
     @login_required
     @user_passes_test(lambda u: u.is_staff)
     def fire_hooks(request):
@@ -1134,8 +951,7 @@ if settings.USE_CF:
             # If no specific job ID was specified, fire hooks for all jobs.
             job_ids = price_class_handler.get_job_ids()
 
-        for job_id in job_ids:
-            fire_gold_hooks(job_id)
+        cf_executor.map(fire_gold_hooks, job_ids)
         context = {'n_jobs': len(job_ids)}
         return render(request, "trs/hooks-fired.html", context)
 
@@ -1234,8 +1050,8 @@ if settings.USE_CF:
                                                  'msg'])
         response_data = list()
 
-        for job_id in job_ids:
-            success_part, msg = collect_judgments(job_id)
+        results = collect_judgments_for_jobs(job_ids)
+        for job_id, (success_part, msg) in zip(job_ids, results):
             success &= success_part
             response_data.append(
                 response_tup(job_id,
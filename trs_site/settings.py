@@ -4,8 +4,20 @@ import os.path
 import sys
 
 # Set defaults before importing localsettings.
-CF_WAIT_SECS = 1
+CF_WAIT_SECS = .5
+CF_MAX_WAIT_SECS = 30
 CF_MAX_WAITS = 30
+CF_RETRY_DEADLINE_SECS = 120
+CF_URL = "https://api.crowdflower.com"
+CF_MAX_CONNECTIONS = 8
+CF_REQUESTS_PER_SEC = 5
+CF_REQUESTS_BURST = 10
+SESSION_CACHE_SIZE = 32
+SWEEP_PROCESSES = 1
+IMPORT_PARSE_PROCESSES = 1
+IMPORT_COPY_THREADS = 8
+ANN_INDEX_DIR = None
+PROGRAM_VERSION_REFRESH = None
 
 # TODO Check that all required config variables have been hereby imported.
 from localsettings import *